@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Measures the parse throughput and memory footprint of heka records.
+
+Records are parsed either without touching their JSON fields, which stay lazy,
+or with every field accessed, which decodes them. The memory per record is the
+growth of the peak resident set size while all parsed records are held, measured
+in a fresh process for each mode.
+
+Example usage:
+python -m benchmarks.bench_heka_parser --records 20000
+"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+from benchmarks.fixtures import make_heka_file, make_pings
+from cStringIO import StringIO
+from moztelemetry.heka_message_parser import parse_heka_message
+
+
+def _touch(cursor):
+    if isinstance(cursor, dict):
+        for value in cursor.itervalues():
+            _touch(value)
+    elif isinstance(cursor, list):
+        for value in cursor:
+            _touch(value)
+
+
+def _parse(data, touch):
+    records = list(parse_heka_message(StringIO(data)))
+    if touch:
+        _touch(records)
+    return records
+
+
+def _measure(args):
+    data, touch = args
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    records = _parse(data, touch)
+    elapsed = time.time() - start
+
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, (after - before)*1024.0/len(records)  # ru_maxrss is in KB on Linux
+
+
+def main(n_records, repeat):
+    data = make_heka_file(make_pings(n_records))
+    print "{} records, {:.1f} MB".format(n_records, len(data)/2.0**20)
+
+    for touch in (False, True):
+        results = []
+        for _ in range(repeat):
+            pool = multiprocessing.Pool(1)
+            results.append(pool.apply(_measure, ((data, touch), )))
+            pool.close()
+            pool.join()
+
+        elapsed = min(elapsed for elapsed, _ in results)
+        memory = min(memory for _, memory in results)
+
+        print "{}: {:.3f}s ({:.0f} records/s), {:.0f} bytes/record".format(
+            "decoded" if touch else "lazy   ", elapsed, n_records/elapsed, memory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the parsing of heka records",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-n", "--records", help="Number of synthetic records", type=int, default=20000)
+    parser.add_argument("-r", "--repeat", help="Number of timed runs, the best one is reported", type=int, default=3)
+
+    args = parser.parse_args()
+    main(args.records, args.repeat)
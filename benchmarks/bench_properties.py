@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Compares the compiled property extractor with the per-ping path interpretation.
+
+The interpreted baseline is the extraction get_pings_properties used before paths
+were compiled, which builds a Histogram per parent and child histogram and adds
+them. Both return a pandas Series per histogram, whose construction dominates;
+the time spent before that, i.e. walking the paths and merging the histograms,
+is reported separately.
+
+Example usage:
+python -m benchmarks.bench_properties --pings 2000 --children 2
+
+Histogram definitions are resolved as usual, so the first run needs network access.
+"""
+
+import argparse
+import time
+
+from benchmarks.fixtures import make_paths, make_pings
+from moztelemetry.histogram import Histogram
+from moztelemetry.spark import _PropertyExtractor
+
+
+# The extraction before paths were compiled, kept as the baseline
+def _get_ping_properties(ping, paths, only_median):
+    result = {}
+
+    for property_name, path in paths:
+        cursor = ping
+
+        if path[0] == "payload":
+            path = path[1:]  # Translate v4 histogram queries to v2 ones
+            cursor = ping["payload"]
+
+        if path[0] == "histograms" or path[0] == "keyedHistograms":
+            props = _get_merged_histograms(cursor, path)
+
+            for k, v in props.iteritems():
+                result[k] = v.get_value(only_median)
+        else:
+            prop = _get_ping_property(cursor, path)
+
+            if prop is None:
+                continue
+
+            result[property_name] = prop
+
+    return result
+
+
+def _get_ping_property(cursor, path):
+    is_histogram = False
+    is_keyed_histogram = False
+
+    if path[0] == "histograms":
+        is_histogram = True
+    elif path[0] == "keyedHistograms":
+        # Deal with histogram names that contain a slash...
+        path = path[:2] + (["/".join(path[2:])] if len(path) > 2 else [])
+        is_keyed_histogram = True
+
+    for partial in path:
+        cursor = cursor.get(partial, None)
+
+        if cursor is None:
+            break
+
+    if cursor is None:
+        return None
+    if is_histogram:
+        return Histogram(path[-1], cursor)
+    elif is_keyed_histogram:
+        histogram = Histogram(path[-2], cursor)
+        histogram.name = "/".join(path[1:])
+        return histogram
+    else:
+        return cursor
+
+
+def _get_merged_histograms(cursor, path):
+    assert((len(path) == 2 and path[0] == "histograms") or (len(path) == 3 and path[0] == "keyedHistograms"))
+    result = {}
+
+    # Get parent histogram
+    parent = _get_ping_property(cursor, path)
+
+    if parent:
+        name = parent.name
+        result[name + "_parent"] = parent
+        result[name] = parent
+
+    cursor = cursor.get("childPayloads", {})
+    if not cursor:  # pre e10s ping
+        return result
+
+    # Get children histograms
+    children = filter(lambda h: h is not None, [_get_ping_property(child, path) for child in cursor])
+
+    if children:
+        name = children[0].name  # The parent histogram might not exist
+        result[name + "_children"] = reduce(lambda x, y: x + y, children)
+
+    # Merge parent and children
+    if parent or children:
+        metrics = ([parent] if parent else []) + children
+        result[name] = reduce(lambda x, y: x + y, metrics)
+
+    return result
+
+
+def _get_ping_histograms(ping, paths):
+    """ Like _get_ping_properties but returns the Histogram objects. """
+    result = {}
+
+    for property_name, path in paths:
+        cursor = ping
+
+        if path[0] == "payload":
+            path = path[1:]
+            cursor = ping["payload"]
+
+        if path[0] == "histograms" or path[0] == "keyedHistograms":
+            result.update(_get_merged_histograms(cursor, path))
+        else:
+            prop = _get_ping_property(cursor, path)
+
+            if prop is not None:
+                result[property_name] = prop
+
+    return result
+
+
+def _time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(n_pings, n_children, repeat):
+    pings = make_pings(n_pings, n_children)
+    paths = make_paths()
+
+    interpreted_paths = [(path, path.split("/")) for path in paths]
+    extractor = _PropertyExtractor(paths)
+
+    # Warm up the definition caches and check that both produce the same properties
+    expected = _get_ping_properties(pings[0], interpreted_paths, False)
+    actual = extractor(pings[0])
+    assert(sorted(expected.keys()) == sorted(actual.keys()))
+
+    interpreted = _time(lambda: [p for p in (_get_ping_properties(p, interpreted_paths, False) for p in pings) if p], repeat)
+    compiled = _time(lambda: list(extractor.extract_partition(pings)), repeat)
+
+    # Without the construction of the Series
+    interpreted_raw = _time(lambda: [_get_ping_histograms(p, interpreted_paths) for p in pings], repeat)
+    compiled_raw = _time(lambda: [(extractor.extract_scalars(p), extractor.extract_histograms(p)) for p in pings], repeat)
+
+    print "{} pings, {} paths, {} child payloads per ping".format(n_pings, len(paths), n_children)
+    print "                 properties            paths and merging"
+    print "interpreted: {:7.3f}s ({:6.0f} pings/s) {:7.3f}s ({:6.0f} pings/s)".format(
+        interpreted, n_pings/interpreted, interpreted_raw, n_pings/interpreted_raw)
+    print "compiled:    {:7.3f}s ({:6.0f} pings/s) {:7.3f}s ({:6.0f} pings/s)".format(
+        compiled, n_pings/compiled, compiled_raw, n_pings/compiled_raw)
+    print "speedup:     {:7.2f}x                  {:7.2f}x".format(interpreted/compiled, interpreted_raw/compiled_raw)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the extraction of ping properties",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-n", "--pings", help="Number of synthetic pings", type=int, default=2000)
+    parser.add_argument("-c", "--children", help="Number of child payloads per ping", type=int, default=2)
+    parser.add_argument("-r", "--repeat", help="Number of timed runs, the best one is reported", type=int, default=3)
+
+    args = parser.parse_args()
+    main(args.pings, args.children, args.repeat)
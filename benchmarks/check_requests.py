@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Checks the S3 requests issued to read v4 submissions.
+
+Files are split in several chunks each, which are read from the sizes and etags
+of the listings, so no key is HEADed. The pings read are checked against the
+fixtures as well.
+
+Example usage:
+python -m benchmarks.check_requests
+"""
+
+from benchmarks.run import Fixtures, SUBMISSION_DATE
+from benchmarks.s3_server import FakeSDB, S3Server
+from moztelemetry.local import LocalContext
+from moztelemetry import spark
+
+
+def main():
+    fixtures = Fixtures(n_pings=500, n_files=3, n_children=0)
+    min_chunk_size = spark._min_chunk_size
+
+    with S3Server(fixtures.buckets) as server, FakeSDB(fixtures.domains):
+        spark.set_s3_endpoint(server.endpoint)
+        spark._min_chunk_size = 2**14  # Several chunks per file
+
+        try:
+            pings = spark.get_pings(LocalContext(), schema="v4", app="Firefox", submission_date=SUBMISSION_DATE)
+            n_chunks = pings.getNumPartitions()
+            ids = sorted(ping["meta"]["Timestamp"] for ping in pings.collect())
+        finally:
+            spark._min_chunk_size = min_chunk_size
+            spark.set_s3_endpoint(None)
+
+    assert n_chunks > len(fixtures.v4_files), "the files should be split in several chunks"
+    assert ids == sorted(ping["meta"]["Timestamp"] for ping in fixtures.pings), "pings were lost or duplicated"
+    assert server.requests["HEAD"] == 0, "{} HEAD requests".format(server.requests["HEAD"])
+    assert server.requests["GET"] >= n_chunks
+
+    print "{} chunks read with {} requests".format(n_chunks, dict(server.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Synthetic Telemetry submissions for the benchmarks.
+
+Pings are generated deterministically from a seed, with the shape of v4 main
+pings: an environment, scalar measurements and a few regular and keyed histograms
+in the payload and in the optional child payloads. They can be serialized as v2
+LZMA files or v4 heka files, with the layout the data pipeline uses.
+
+Example usage:
+pings = make_pings(1000, n_children=2)
+v4_file = make_heka_file(pings)
+v2_file = make_v2_file(pings)
+"""
+
+import json
+import liblzma as lzma
+import random
+import struct
+
+from telemetry.util.heka_message import message_pb2
+
+HISTOGRAMS = ["GC_MS", "CYCLE_COLLECTOR", "GC_REASON_2", "TELEMETRY_PING", "FX_TAB_SWITCH_TOTAL_MS"]
+KEYED_HISTOGRAMS = [("SEARCH_COUNTS", "google.urlbar")]
+SCALARS = ["clientId", "meta/Timestamp", "meta/appUpdateChannel", "environment/build/buildId",
+           "environment/system/os/name", "payload/info/reason", "payload/info/subsessionLength",
+           "payload/simpleMeasurements/uptime", "payload/simpleMeasurements/firstPaint"]
+
+# The parts of the submission that the pipeline stores as separate heka fields
+HEKA_FIELDS = [("environment", "build"), ("environment", "settings"), ("environment", "system"),
+               ("environment", "addons"), ("payload", "histograms"), ("payload", "keyedHistograms"),
+               ("payload", "simpleMeasurements"), ("payload", "info")]
+
+
+def _histogram(rng):
+    n_buckets = rng.randint(1, 10)
+    values = {str(2**i): rng.randint(0, 100) for i in range(n_buckets)}
+    values[str(2**n_buckets)] = 0  # The first empty bucket after the data is always present
+
+    return {"values": values, "sum": rng.randint(0, 1000), "bucket_count": 50,
+            "histogram_type": 0, "range": [1, 10000]}
+
+
+def _payload(rng):
+    return {"info": {"reason": "shutdown", "subsessionLength": rng.randint(0, 3600)},
+            "simpleMeasurements": {"uptime": rng.randint(0, 100), "firstPaint": rng.randint(0, 10000)},
+            "histograms": {name: _histogram(rng) for name in HISTOGRAMS},
+            "keyedHistograms": {name: {key: _histogram(rng)} for name, key in KEYED_HISTOGRAMS}}
+
+
+def make_pings(n_pings, n_children=0, seed=42):
+    rng = random.Random(seed)
+    pings = []
+
+    for i in range(n_pings):
+        payload = _payload(rng)
+        payload["childPayloads"] = [_payload(rng) for _ in range(n_children)]
+        pings.append({"clientId": "client-{}".format(rng.randint(0, n_pings)),
+                      "meta": {"Timestamp": 1440000000000000000 + i, "appUpdateChannel": "nightly"},
+                      "environment": {"build": {"buildId": "20150801030206"},
+                                      "settings": {"telemetryEnabled": True, "locale": "en-US"},
+                                      "system": {"os": {"name": "Linux"}, "memoryMB": rng.choice([2048, 4096, 8192])},
+                                      "addons": {"activeAddons": {"addon-{}".format(j): {"version": "1.0"}
+                                                                  for j in range(rng.randint(0, 5))}}},
+                      "payload": payload})
+
+    return pings
+
+
+def make_paths():
+    return SCALARS + \
+        ["payload/histograms/{}".format(name) for name in HISTOGRAMS] + \
+        ["payload/keyedHistograms/{}/{}".format(name, key) for name, key in KEYED_HISTOGRAMS]
+
+
+def make_heka_record(ping, index=0):
+    """ Returns a heka framed record of a ping, without meta, as stored by the data pipeline. """
+    submission = {key: (dict(value) if isinstance(value, dict) else value)
+                  for key, value in ping.iteritems() if key != "meta"}
+
+    message = message_pb2.Message()
+    message.uuid = struct.pack("<QQ", index, ping["meta"]["Timestamp"])
+    message.timestamp = ping["meta"]["Timestamp"]
+    message.type = "telemetry"
+    message.hostname = "localhost"
+
+    meta = [("docType", "main"), ("appUpdateChannel", ping["meta"]["appUpdateChannel"]),
+            ("normalizedChannel", ping["meta"]["appUpdateChannel"]), ("clientId", ping["clientId"]),
+            ("appBuildId", ping["environment"]["build"]["buildId"])]
+
+    for name, value in meta:
+        field = message.fields.add()
+        field.name = name
+        field.value_string.append(value)
+
+    for parent, child in HEKA_FIELDS:
+        if child in submission.get(parent, {}):
+            field = message.fields.add()
+            field.name = "{}.{}".format(parent, child)
+            field.value_string.append(json.dumps(submission[parent].pop(child)))
+
+    message.payload = json.dumps(submission)
+
+    message_raw = message.SerializeToString()
+    header = message_pb2.Header()
+    header.message_length = len(message_raw)
+    header_raw = header.SerializeToString()
+
+    return struct.pack("<BB", 0x1e, len(header_raw)) + header_raw + chr(0x1f) + message_raw
+
+
+def make_heka_file(pings):
+    return "".join(make_heka_record(ping, i) for i, ping in enumerate(pings))
+
+
+def make_v2_file(pings):
+    """ Returns a LZMA compressed file of v2 submissions, one "<uuid>\\t<json>" line each. """
+    lines = []
+
+    for i, ping in enumerate(pings):
+        submission = {"ver": 2, "info": {"reason": "saved-session", "appUpdateChannel": ping["meta"]["appUpdateChannel"],
+                                         "appBuildID": ping["environment"]["build"]["buildId"]},
+                      "simpleMeasurements": ping["payload"]["simpleMeasurements"],
+                      "histograms": {name: _v2_histogram(histogram)
+                                     for name, histogram in ping["payload"]["histograms"].iteritems()}}
+        lines.append("{:032x}\t{}\n".format(i, json.dumps(submission)))
+
+    return lzma.compress("".join(lines))
+
+
+def _v2_histogram(histogram):
+    # Bucket counts followed by sum, log_sum, log_sum_squares, sum_squares_lo and sum_squares_hi
+    counts = [0]*histogram["bucket_count"]
+    for label, count in histogram["values"].iteritems():
+        counts[min(len(bin(int(label))) - 2, len(counts) - 1)] += count
+
+    return counts + [histogram["sum"], -1, -1, 0, 0]
+
+
+def v2_filename(submission_date, index):
+    return "saved_session/Firefox/nightly/40.0a1/20150801030206.{}.v2.log.{}.lzma".format(submission_date, index)
+
+
+def v4_filename(submission_date, index):
+    return "telemetry-2/{}/telemetry/4/main/Firefox/nightly/40.0a1/20150801030206/{:04d}.heka".format(submission_date, index)
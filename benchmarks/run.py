@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Times the hot paths of the Telemetry API end to end, on synthetic submissions.
+
+The submissions are served by an in-process S3 stand-in and indexed by a fake
+SimpleDB, so no network access is needed besides the histogram definitions.
+The results are written as JSON, along with the current commit, so that runs
+can be compared across commits.
+
+Example usage:
+python -m benchmarks.run --pings 5000 --output results.json
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from cStringIO import StringIO
+
+from benchmarks.bench_properties import _get_ping_properties
+from benchmarks.fixtures import make_heka_file, make_paths, make_pings, make_v2_file, v2_filename, v4_filename
+from benchmarks.s3_server import FakeSDB, S3Server
+from moztelemetry.filter_service import SDB
+from moztelemetry.heka_message_parser import parse_heka_message
+from moztelemetry.histogram import Histogram
+from moztelemetry.local import LocalContext
+from moztelemetry import spark
+
+SUBMISSION_DATE = "20150801"
+V2_ATTRIBUTES = {"appName": "Firefox", "appUpdateChannel": "nightly", "appVersion": "40.0a1",
+                 "appBuildID": "20150801030206", "submissionDate": SUBMISSION_DATE, "reason": "saved_session"}
+V4_ATTRIBUTES = {"appName": "Firefox", "appUpdateChannel": "nightly", "appVersion": "40.0a1",
+                 "appBuildID": "20150801030206", "submissionDate": SUBMISSION_DATE, "sourceName": "telemetry",
+                 "sourceVersion": "4", "docType": "main"}
+
+
+class Fixtures:
+    def __init__(self, n_pings, n_files, n_children):
+        self.pings = make_pings(n_pings, n_children)
+        self.paths = make_paths()
+
+        slices = [self.pings[i*n_pings/n_files:(i + 1)*n_pings/n_files] for i in range(n_files)]
+        self.v2_files = {v2_filename(SUBMISSION_DATE, i): make_v2_file(pings) for i, pings in enumerate(slices)}
+        self.v4_files = {v4_filename(SUBMISSION_DATE, i): make_heka_file(pings) for i, pings in enumerate(slices)}
+
+        self.buckets = {spark._bucket_v2_name: self.v2_files, spark._bucket_v4_name: self.v4_files}
+        self.domains = {"telemetry_v2_201508": {name: V2_ATTRIBUTES for name in self.v2_files},
+                        "telemetry_v4_201508": {name: V4_ATTRIBUTES for name in self.v4_files}}
+
+        self.histograms = [(name, histogram) for ping in self.pings
+                           for name, histogram in ping["payload"]["histograms"].iteritems()]
+
+
+def bench_read_v2(fixtures):
+    return sum(1 for filename in fixtures.v2_files for _ in spark._read_v2(filename))
+
+
+def bench_read_v4(fixtures):
+    return sum(1 for key in spark._get_bucket_v4().list() for _ in spark._read_v4(key))
+
+
+def bench_parse_heka_message(fixtures):
+    return sum(1 for data in fixtures.v4_files.itervalues() for _ in parse_heka_message(StringIO(data)))
+
+
+def bench_get_ping_properties(fixtures):
+    paths = [(path, path.split("/")) for path in fixtures.paths]
+    return len([_get_ping_properties(ping, paths, False) for ping in fixtures.pings])
+
+
+def bench_property_extractor(fixtures):
+    return len(list(spark._PropertyExtractor(fixtures.paths).extract_partition(fixtures.pings)))
+
+
+def bench_histogram_construction(fixtures):
+    return len([Histogram(name, histogram) for name, histogram in fixtures.histograms])
+
+
+def bench_histogram_addition(fixtures):
+    totals = {}
+
+    for name, histogram in fixtures.histograms:
+        histogram = Histogram(name, histogram)
+        totals[name] = totals[name] + histogram if name in totals else histogram
+
+    return len(fixtures.histograms)
+
+
+def bench_sdb_query(fixtures):
+    sdb = SDB("telemetry_v4")
+    queries = 100
+
+    for _ in range(queries):
+        sdb.query(submissionDate=(SUBMISSION_DATE, SUBMISSION_DATE), appName="Firefox",
+                  appBuildID=("20150801000000", "20150801999999"))
+
+    return queries
+
+
+def bench_get_pings_v4_local(fixtures):
+    return spark.get_pings(LocalContext(), schema="v4", app="Firefox", submission_date=SUBMISSION_DATE).count()
+
+
+BENCHMARKS = [bench_read_v2, bench_read_v4, bench_parse_heka_message, bench_get_ping_properties,
+              bench_property_extractor, bench_histogram_construction, bench_histogram_addition,
+              bench_sdb_query, bench_get_pings_v4_local]
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(n_pings, n_files, n_children, repeat, selected=None):
+    fixtures = Fixtures(n_pings, n_files, n_children)
+    results = {}
+
+    with S3Server(fixtures.buckets) as server, FakeSDB(fixtures.domains):
+        spark.set_s3_endpoint(server.endpoint)
+
+        try:
+            for benchmark in BENCHMARKS:
+                name = benchmark.__name__[len("bench_"):]
+                if selected and name not in selected:
+                    continue
+
+                items = benchmark(fixtures)  # Warm up the caches, e.g. of histogram definitions
+                timings = []
+
+                for _ in range(repeat):
+                    start = time.time()
+                    benchmark(fixtures)
+                    timings.append(time.time() - start)
+
+                best = min(timings)
+                results[name] = {"seconds": best, "items": items, "items_per_second": items/best if best else None}
+                print >> sys.stderr, "{:<24} {:8.3f}s {:12.0f} items/s".format(name, best, items/best if best else 0)
+        finally:
+            spark.set_s3_endpoint(None)
+
+    return {"commit": _get_commit(),
+            "date": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "parameters": {"pings": n_pings, "files": n_files, "children": n_children, "repeat": repeat},
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the Telemetry API",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-n", "--pings", help="Number of synthetic pings", type=int, default=2000)
+    parser.add_argument("-f", "--files", help="Number of files the pings are split in", type=int, default=4)
+    parser.add_argument("-c", "--children", help="Number of child payloads per ping", type=int, default=1)
+    parser.add_argument("-r", "--repeat", help="Number of timed runs, the best one is reported", type=int, default=3)
+    parser.add_argument("-b", "--benchmark", help="Run only the given benchmarks", action="append", default=None)
+    parser.add_argument("-o", "--output", help="File the JSON results are written to, instead of stdout", default=None)
+
+    args = parser.parse_args()
+    report = main(args.pings, args.files, args.children, args.repeat, args.benchmark)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" In-process stand-ins for S3 and SimpleDB.
+
+S3Server serves objects held in memory over HTTP, with the subset of the S3 API
+that boto uses to read keys (including ranged GETs), HEAD them and list buckets.
+The requests served are counted per method in S3Server.requests, e.g. to check
+that a code path doesn't HEAD keys. FakeSDB replaces boto's SimpleDB connection,
+so that filter_service.SDB queries an in-memory index of the objects.
+
+Example usage:
+with S3Server({"bucket": {"some/key": "data"}}) as server:
+    set_s3_endpoint(server.endpoint)
+    ...
+"""
+
+import BaseHTTPServer
+import SocketServer
+import boto.sdb
+import collections
+import hashlib
+import os
+import re
+import socket
+import threading
+import urllib
+import urlparse
+
+from xml.sax.saxutils import escape
+
+_last_modified = "Sat, 01 Aug 2015 00:00:00 GMT"
+
+
+class S3Server:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.requests = collections.Counter()
+        self._etags = {}
+        self._lock = threading.Lock()
+
+        class Handler(_S3Handler):
+            s3 = self
+
+        self._server = _ThreadingServer(("127.0.0.1", 0), Handler)
+        self.endpoint = "http://127.0.0.1:{}".format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        # boto refuses to connect without credentials
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.close_connections()
+        self._server.server_close()
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] += 1
+
+    def etag(self, bucket, name):
+        if (bucket, name) not in self._etags:
+            self._etags[(bucket, name)] = hashlib.md5(self.buckets[bucket][name]).hexdigest()
+        return self._etags[(bucket, name)]
+
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self._connections = set()
+
+    def process_request(self, request, client_address):
+        self._connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        # Kept-alive connections would otherwise block their threads until exit
+        for connection in list(self._connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _S3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as boto reuses its connections
+    disable_nagle_algorithm = True
+    wbufsize = -1  # Headers and body are sent together
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self, send_body):
+        self.s3.count(self.command)
+        url = urlparse.urlparse(self.path)
+        bucket, _, name = urllib.unquote(url.path).lstrip("/").partition("/")
+        objects = self.s3.buckets.get(bucket)
+
+        if objects is None:
+            return self._send(404, _error("NoSuchBucket"), send_body=send_body)
+        elif not name:
+            query = dict(urlparse.parse_qsl(url.query))
+            return self._send(200, _listing(bucket, objects, self.s3, query), send_body=send_body)
+        elif name not in objects:
+            return self._send(404, _error("NoSuchKey"), send_body=send_body)
+
+        data = objects[name]
+        headers = {"ETag": '"{}"'.format(self.s3.etag(bucket, name)), "Last-Modified": _last_modified}
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) + 1 if match.group(2) else len(data), len(data))
+
+            if start >= len(data):
+                return self._send(416, _error("InvalidRange"), send_body=send_body)
+
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end - 1, len(data))
+            return self._send(206, data[start:end], headers, send_body)
+
+        self._send(200, data, headers, send_body)
+
+    def _send(self, status, body, headers={}, send_body=True):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+
+        self.end_headers()
+
+        if send_body:
+            self.wfile.write(body)
+
+
+def _error(code):
+    return "<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{}</Code></Error>".format(code)
+
+
+def _listing(bucket, objects, s3, query):
+    prefix = query.get("prefix", "")
+    delimiter = query.get("delimiter", "")
+    marker = query.get("marker", "")
+    contents, prefixes = [], set()
+
+    for name in sorted(objects):
+        if not name.startswith(prefix) or name <= marker:
+            continue
+
+        rest = name[len(prefix):]
+        if delimiter and delimiter in rest:
+            prefixes.add(prefix + rest[:rest.index(delimiter) + 1])
+        else:
+            contents.append("<Contents><Key>{}</Key><LastModified>2015-08-01T00:00:00.000Z</LastModified>"
+                            "<ETag>&quot;{}&quot;</ETag><Size>{}</Size><StorageClass>STANDARD</StorageClass>"
+                            "</Contents>".format(escape(name), s3.etag(bucket, name), len(objects[name])))
+
+    common_prefixes = ["<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>".format(escape(p)) for p in sorted(prefixes)]
+
+    return "<?xml version=\"1.0\" encoding=\"UTF-8\"?>" \
+        "<ListBucketResult><Name>{}</Name><Prefix>{}</Prefix><Marker>{}</Marker><IsTruncated>false</IsTruncated>" \
+        "{}{}</ListBucketResult>".format(escape(bucket), escape(prefix), escape(marker),
+                                         "".join(contents), "".join(common_prefixes))
+
+
+class FakeSDB:
+    """
+    Replaces boto.sdb.connect_to_region while in use. Domains map item names, i.e.
+    filenames, to their attributes, e.g. {"telemetry_v4_201508": {"some/key": {...}}}.
+    Only the conjunctions of comparisons that SDB.query generates are supported.
+    """
+
+    def __init__(self, domains):
+        self.domains = domains
+
+    def __enter__(self):
+        self._connect = boto.sdb.connect_to_region
+        boto.sdb.connect_to_region = lambda region, **kwargs: _FakeSDBConnection(self.domains)
+        return self
+
+    def __exit__(self, *args):
+        boto.sdb.connect_to_region = self._connect
+
+
+class _FakeSDBConnection:
+    def __init__(self, domains):
+        self._domains = domains
+
+    def get_all_domains(self):
+        return [_FakeDomain(name, items) for name, items in self._domains.iteritems()]
+
+    def get_domain(self, name):
+        return _FakeDomain(name, self._domains[name])
+
+
+class _FakeDomain:
+    def __init__(self, name, items):
+        self.name = name
+        self._items = items
+
+    def select(self, query):
+        conditions = re.findall(r"(\w+) (=|>=|<=) '([^']*)'", query.partition(" where ")[2])
+        return [_FakeItem(name) for name, attributes in sorted(self._items.iteritems())
+                if all(_compare(attributes.get(attribute), operator, value) for attribute, operator, value in conditions)]
+
+
+class _FakeItem:
+    def __init__(self, name):
+        self.name = name
+
+
+def _compare(actual, operator, value):
+    if actual is None:
+        return False
+    elif operator == "=":
+        return actual == value
+    elif operator == ">=":
+        return actual >= value
+    else:
+        return actual <= value
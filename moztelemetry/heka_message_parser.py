@@ -5,48 +5,435 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import snappy
 import ujson as json
-import ssl
 
-from telemetry.util.heka_message import unpack, BacktrackableFile
+from binascii import crc32
+from google.protobuf.message import DecodeError
+from metrics import metered
+from s3_reader import TRANSIENT_ERRORS
 
+from telemetry.util.heka_message import message_pb2
+
+_block_size = 2**22
+_record_separator = 0x1e
+_unit_separator = 0x1f
+
+
+def parse_heka_message(message, boundary_bytes=None, sample_ids=None, projection=None, record_filter=None, stats=None,
+                       metrics=None):
+    """
+    Parses the heka records of a stream. If boundary_bytes is set, only the records
+    that start within that many bytes of the stream are parsed, so that consecutive
+    chunks of a file each parse the records that start within them. If sample_ids is
+    set, only the records of clients whose sample id is within the set are decoded.
+    If projection is set to a list of paths, e.g. ["clientId", "payload/histograms/GC_MS"],
+    only those parts of the records are decoded; see _parse_heka_record. If
+    record_filter is set, only the records whose message fields match it are decoded,
+    see RecordFilter; the number of rejected records is added to the "filtered_records"
+    counter of stats. The framing and decoding stages are accounted in the optional
+    metrics.PipelineMetrics.
+    """
+    if projection is not None:
+        projection = _Projection(projection)
+
+    if record_filter is not None and not isinstance(record_filter, RecordFilter):
+        record_filter = RecordFilter(record_filter)
+
+    reader = HekaReader(message, limit=boundary_bytes or None)
+    records = reader if metrics is None else metered(reader, metrics, "framing")
+    total_bytes = 0
 
-def parse_heka_message(message, boundary_bytes=None):
     try:
-        message = BacktrackableFile(message)
+        for record, total_bytes in records:
+            payload = None
+
+            if record_filter is not None and not record_filter.accepts(record):
+                if stats:
+                    stats.add("filtered_records")
+                continue
+
+            if sample_ids is not None:
+                sample_id, payload = _get_sample_id(record)
+                if sample_id not in sample_ids:
+                    continue
+
+            if metrics is None:
+                yield _parse_heka_record(record, projection, payload)
+            else:
+                yield _parse_metered_heka_record(record, projection, metrics, payload)
+
+    except TRANSIENT_ERRORS:
+        pass  # Reads are resumed, this is only raised once they have been abandoned
+    finally:
+        message.close()
+
+        if metrics is not None:
+            metrics.add("framing", "bytes", total_bytes)
+            metrics.add("framing", "errors", reader.corrupted)
+
+
+class HekaReader:
+    """ Splits a stream in heka messages.
+
+    The stream is read by large blocks into a buffer, in which the records are
+    framed and handed to the protobuf and snappy decoders as memoryview slices.
+    Iterating yields (message, total_bytes) tuples, where total_bytes is the
+    offset in the stream of the end of the record. If limit is set, only the
+    records that start before that offset are returned.
+
+    The stream might start in the middle of a record, e.g. for a ranged read, and
+    records might be corrupted. In both cases the reader resynchronizes on the
+    next record separator. As separators can also appear within records, the
+    first record after a resynchronization must be followed by another separator.
+
+    See https://hekad.readthedocs.org/en/latest/message/index.html for the framing.
+    """
+
+    def __init__(self, stream, block_size=_block_size, limit=None):
+        self._stream = stream
+        self._block_size = block_size
+        self._limit = limit
+        self._buffer = bytearray()
+        self._start = 0  # Position of the current record in the buffer
+        self._offset = 0  # Offset in the stream of the beginning of the buffer
+        self._eof = False
+        self._resync = True
+        self.corrupted = 0  # Number of records skipped after the first valid one
+
+    def __iter__(self):
+        while self._find_record():
+            if self._limit is not None and self._offset + self._start >= self._limit:
+                return
+
+            header_length = self._buffer[self._start + 1]
+
+            if not self._fill(3 + header_length):
+                return
+
+            header = self._parse_header(self._start + 2, header_length)
+            if header is None:
+                self._skip()
+                continue
+
+            record_length = 3 + header_length + header.message_length
+            if not self._fill(record_length):
+                return
+
+            message = self._parse_message(self._start + record_length - header.message_length, header.message_length)
+            if message is None:
+                self._skip()
+                continue
+
+            if self._resync:
+                if not self._is_followed(record_length):
+                    self._skip()
+                    continue
+
+                self._resync = False
+
+            self._start += record_length
+            yield message, self._offset + self._start
+
+    def _is_followed(self, record_length):
+        # Checks that the framing of the next record, if any, is valid
+        if not self._fill(record_length + 2):
+            return len(self._buffer) - self._start == record_length
+
+        end = self._start + record_length
+        if self._buffer[end] != _record_separator:
+            return False
+
+        header_length = self._buffer[end + 1]
+        if not self._fill(record_length + 3 + header_length):
+            return True
+
+        return self._buffer[self._start + record_length + 2 + header_length] == _unit_separator
+
+    def _skip(self):
+        if not self._resync:
+            self.corrupted += 1
+
+        self._start += 1
+        self._resync = True
+
+    def _find_record(self):
+        # Skips to the next record separator, with its header length
+        while True:
+            index = self._buffer.find(chr(_record_separator), self._start)
+
+            if index >= 0:
+                self._start = index
+                return self._fill(2)
+
+            self._start = len(self._buffer)
+            if not self._fill(1):
+                return False
+
+    def _fill(self, size):
+        # Makes sure that at least size bytes are buffered from the current record
+        while len(self._buffer) - self._start < size:
+            if self._eof:
+                return False
+
+            data = self._stream.read(max(self._block_size, size))
+            if not data:
+                self._eof = True
+                return False
 
-        for record, total_bytes in unpack(message, backtrack=True):
-            yield _parse_heka_record(record)
+            # The consumed part of the buffer is dropped
+            if self._start:
+                del self._buffer[:self._start]
+                self._offset += self._start
+                self._start = 0
 
-            if boundary_bytes and (total_bytes >= boundary_bytes):
-                message.close()
-                break
+            self._buffer.extend(data)
 
-    except ssl.SSLError:
-        pass  # https://github.com/boto/boto/issues/2830
+        return True
 
+    def _parse_header(self, start, length):
+        if self._buffer[start + length] != _unit_separator:
+            return None
+
+        header = message_pb2.Header()
+
+        try:
+            header.ParseFromString(memoryview(self._buffer)[start:start + length])
+        except DecodeError:
+            return None
+
+        return header
+
+    def _parse_message(self, start, length):
+        view = memoryview(self._buffer)[start:start + length]
+        message = message_pb2.Message()
+
+        try:
+            message.ParseFromString(snappy.decompress(view))
+            if _is_valid(message):
+                return message
+        except Exception:
+            pass  # Not compressed
+
+        try:
+            message.ParseFromString(view)
+        except DecodeError:
+            return None
+
+        return message if _is_valid(message) else None
+
+
+def _parse_heka_record(message, projection=None, payload=None):
+    """
+    Decodes a message. With a projection, the dotted fields outside of it are skipped
+    and the JSON payload is decoded only if some path isn't served by the fields, in
+    which case the payload is pruned to the projected subtrees. The meta fields are
+    always returned. A payload that was decoded already can be passed to be reused.
+    """
+    fields = message.fields
+
+    if projection is not None:
+        fields = [field for field in fields if projection.selects(field.name.split('.'))]
+
+        if projection.needs_payload(fields):
+            result = projection.prune(json.loads(message.payload) if payload is None else payload)
+        else:
+            result = {}
+    else:
+        result = json.loads(message.payload) if payload is None else payload
 
-def _parse_heka_record(record):
-    result = json.loads(record.message.payload)
     result["meta"] = {
         # TODO: uuid, logger, severity, env_version, pid
-        "Timestamp": record.message.timestamp,
-        "Type":      record.message.type,
-        "Hostname":  record.message.hostname,
+        "Timestamp": message.timestamp,
+        "Type":      message.type,
+        "Hostname":  message.hostname,
     }
 
-    for field in record.message.fields:
+    for field in fields:
         name = field.name.split('.')
         value = field.value_string
 
-	if len(name) == 1:  # Treat top-level meta fields as strings
-	    result["meta"][name[0]] = value[0] if len(value) else ""
-	else:
-	    _add_field(result, name, value)
+        if len(name) == 1:  # Treat top-level meta fields as strings
+            result["meta"][name[0]] = value[0] if len(value) else ""
+        else:
+            _add_field(result, name, value)
+
+    return result
+
+
+def _is_valid(message):
+    # Messages always have an uuid and a timestamp
+    return message.IsInitialized() and len(message.uuid) == 16
+
+
+class RecordFilter:
+    """ A conjunction of conditions on the fields of heka messages.
+
+    The conditions are given as a dictionary keyed by field name, e.g. "normalizedChannel",
+    "appBuildId" or one of the message headers "Timestamp", "Type" and "Hostname". A
+    condition is either:
+    - a value, which the field must be equal to;
+    - a (min, max) tuple of inclusive bounds, either of which can be None;
+    - a list or set of accepted values;
+    - a callable which returns whether a value is accepted.
+    Records that lack a field are passed None, which is only accepted by callables.
+
+    Example usage:
+    record_filter = RecordFilter({"normalizedChannel": "nightly",
+                                  "appBuildId": ("20150601000000", None),
+                                  "os": lambda os: os in ("Linux", "Darwin")})
+    """
+
+    def __init__(self, conditions):
+        self.conditions = [(name, _get_condition(condition)) for name, condition in conditions.iteritems()]
+        self._fields = frozenset(name for name, _ in self.conditions if name not in _headers)
+
+    def accepts(self, message):
+        values = {}
+
+        if self._fields:
+            for field in message.fields:
+                if field.name in self._fields:
+                    values[field.name] = _get_field_value(field)
+
+        for name, condition in self.conditions:
+            value = getattr(message, _headers[name]) if name in _headers else values.get(name, None)
+
+            if not condition(value):
+                return False
+
+        return True
+
+
+_headers = {"Timestamp": "timestamp", "Type": "type", "Hostname": "hostname"}
+
+
+def _get_condition(condition):
+    if callable(condition):
+        return condition
+    elif isinstance(condition, tuple):
+        low, high = condition
+        return lambda value: value is not None and (low is None or value >= low) and (high is None or value <= high)
+    elif isinstance(condition, (list, set, frozenset)):
+        accepted = frozenset(condition)
+        return lambda value: value in accepted
+    else:
+        return lambda value: value == condition
+
+
+def _get_field_value(field):
+    for values in (field.value_string, field.value_integer, field.value_double, field.value_bool):
+        if len(values):
+            return values[0]
+
+    return None
+
+
+def _parse_metered_heka_record(message, projection, metrics, payload=None):
+    metrics.start("decoding")
 
+    try:
+        result = _parse_heka_record(message, projection, payload)
+    except:
+        metrics.stop(errors=1)
+        raise
+
+    metrics.stop(bytes=len(message.payload), records=1)
     return result
 
 
+class _Projection:
+    """ A prefix tree of paths, where None stands for a whole subtree. """
+
+    def __init__(self, paths):
+        self.tree = {}
+
+        for path in paths:
+            path = path.split("/") if isinstance(path, basestring) else list(path)
+            node = self.tree
+
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+                if node is None:  # A parent is already selected as a whole
+                    break
+            else:
+                node[path[-1]] = None
+
+        self.leaves = [leaf for leaf in _leaves(self.tree) if leaf[0] != "meta"]
+
+    def selects(self, name):
+        if len(name) == 1:
+            return True  # Top-level fields are meta fields
+
+        node = self.tree
+        for key in name:
+            if node is None:
+                return True
+            if key not in node:
+                return False
+            node = node[key]
+
+        return True
+
+    def needs_payload(self, fields):
+        # A dotted field holds the whole subtree of the payload at its path, while
+        # top-level fields are returned as meta fields and never cover the payload
+        names = set(tuple(field.name.split('.')) for field in fields if '.' in field.name)
+        return any(all(leaf[:i] not in names for i in range(1, len(leaf) + 1)) for leaf in self.leaves)
+
+    def prune(self, payload):
+        return _prune(payload, self.tree)
+
+
+def _leaves(tree, prefix=()):
+    for key, node in tree.iteritems():
+        if node is None:
+            yield prefix + (key, )
+        else:
+            for leaf in _leaves(node, prefix + (key, )):
+                yield leaf
+
+
+def _prune(cursor, node):
+    if node is None or not isinstance(cursor, dict):
+        return cursor
+
+    return {key: _prune(cursor[key], node[key]) for key in node if key in cursor}
+
+
+def get_sample_id(client_id):
+    """ Returns the sample id of a client, as computed by the data pipeline. """
+    if isinstance(client_id, unicode):
+        client_id = client_id.encode("utf-8")
+
+    return (crc32(client_id) & 0xffffffff) % 100
+
+
+def _get_sample_id(message):
+    """
+    Returns the sample id of a message and its decoded payload, if it had to be
+    decoded. The sample id is read from the message fields, so that the payload of
+    records outside of the sample doesn't have to be decoded; records of older
+    pipelines, which lack these fields, are decoded once and the payload reused.
+    """
+    client_id = None
+    payload = None
+
+    for field in message.fields:
+        if field.name == "sampleId":
+            value = field.value_integer or field.value_double or field.value_string
+            if len(value):
+                return int(value[0]), None
+        elif field.name == "clientId" and len(field.value_string):
+            client_id = field.value_string[0]
+
+    if client_id is None:
+        payload = json.loads(message.payload)
+        client_id = payload.get("clientId", None)
+
+    return (get_sample_id(client_id) if client_id else None), payload
+
+
 def _add_field(container, keys, value):
     if len(keys) == 1:
         blob = value[0] if len(value) else ""
@@ -63,33 +450,170 @@ def _lazyjson(content):
         raise ValueError("Argument must be a string.")
 
     if content.startswith("{"):
-        default = {}
+        return _LazyDict(content)
     elif content.startswith("["):
-        default = []
+        return _LazyList(content)
     else:
         try:
             return float(content) if '.' in content or 'e' in content.lower() else int(content)
         except:
             return content
 
-    class WrapperType(type(default)):
-        pass
 
-    def wrap(method_name):
-        def _wrap(*args, **kwargs):
-            if not hasattr(WrapperType, '__cache__'):
-                setattr(WrapperType, '__cache__', json.loads(content))
+class _JSONDict(dict):
+    """ A decoded _LazyDict. """
+    __slots__ = ("_content", )
 
-            cached = WrapperType.__cache__
-            method = getattr(cached, method_name)
-            return method(*args[1:], **kwargs)
+    def __reduce__(self):
+        return (dict, (dict(self), ))
 
-        return _wrap
 
-    wrapper = WrapperType(default)
-    for k, v in type(default).__dict__.iteritems():
-        if k == "__doc__":
-            continue
-        else:
-            setattr(WrapperType, k, wrap(k))
-    return wrapper
+class _JSONList(list):
+    """ A decoded _LazyList. """
+    __slots__ = ("_content", )
+
+    def __reduce__(self):
+        return (list, (list(self), ))
+
+
+class _LazyDict(_JSONDict):
+    """
+    A dictionary that is decoded from its JSON content on first use. Once decoded, the
+    instance turns into a _JSONDict, so that further accesses cost as much as for a dict.
+    """
+    __slots__ = ()
+
+    def __init__(self, content):
+        self._content = content
+
+    def __reduce__(self):
+        return (_LazyDict, (self._content, ))
+
+    def _decode(self):
+        dict.update(self, json.loads(self._content))
+
+
+class _LazyList(_JSONList):
+    """ A list that is decoded from its JSON content on first use, see _LazyDict. """
+    __slots__ = ()
+
+    def __init__(self, content):
+        self._content = content
+
+    def __reduce__(self):
+        return (_LazyList, (self._content, ))
+
+    def _decode(self):
+        list.extend(self, json.loads(self._content))
+
+
+def _add_decoding_methods(lazy_type, decoded_type):
+    # The methods of the container are overridden once for all instances; the first
+    # call decodes the content and then resolves the method on the decoded type.
+    base = decoded_type.__bases__[0]
+
+    def decoding(name):
+        def decode_and_call(self, *args, **kwargs):
+            self._decode()
+            self.__class__ = decoded_type
+            self._content = None
+            return getattr(self, name)(*args, **kwargs)
+
+        decode_and_call.__name__ = name
+        return decode_and_call
+
+    for name, attribute in base.__dict__.iteritems():
+        if callable(attribute) and name not in _undecoded_methods:
+            setattr(lazy_type, name, decoding(name))
+
+
+_undecoded_methods = frozenset(("__new__", "__init__", "__getattribute__", "__setattr__", "__delattr__",
+                                "__hash__", "__reduce__", "__reduce_ex__", "__sizeof__", "__subclasshook__",
+                                "__format__", "__class__", "fromkeys"))
+
+_add_decoding_methods(_LazyDict, _JSONDict)
+_add_decoding_methods(_LazyList, _JSONList)
+
+
+if __name__ == "__main__":
+    import random
+    import struct
+
+    from cStringIO import StringIO
+
+    def make_record(rng, i):
+        message = message_pb2.Message()
+        message.uuid = struct.pack("<QQ", i, 0)
+        message.timestamp = i
+        # Separators within the payload make resynchronizations ambiguous
+        message.payload = "".join(rng.choice("\x1e\x1f{}ab") for _ in range(rng.randint(0, 3000)))
+
+        message_raw = message.SerializeToString()
+        header = message_pb2.Header()
+        header.message_length = len(message_raw)
+        header_raw = header.SerializeToString()
+
+        return struct.pack("<BB", _record_separator, len(header_raw)) + header_raw + chr(_unit_separator) + message_raw
+
+    # Consecutive chunks of a file return each record exactly once
+    rng = random.Random(42)
+    data = "".join(make_record(rng, i) for i in range(500))
+    expected = [message.timestamp for message, _ in HekaReader(StringIO(data))]
+    assert(expected == range(500))
+
+    for chunk_size in [1000, 4096, 77777, len(data)]:
+        actual = []
+        for start in range(0, len(data), chunk_size):
+            reader = HekaReader(StringIO(data[start:]), block_size=rng.choice([1, 512, _block_size]), limit=chunk_size)
+            actual.extend(message.timestamp for message, _ in reader)
+
+        assert(actual == expected)
+
+    # Client samples are read from the sampleId and clientId fields, falling back to
+    # the payload, which is then only decoded once per record
+    def make_sampled_record(i, field):
+        message = message_pb2.Message()
+        message.uuid = struct.pack("<QQ", i, 0)
+        message.timestamp = i
+        message.payload = json.dumps({"clientId": "client-{}".format(i)})
+
+        if field == "sampleId":
+            message.fields.add(name="sampleId", value_integer=[get_sample_id("client-{}".format(i))])
+        elif field == "clientId":
+            message.fields.add(name="clientId", value_string=["client-{}".format(i)])
+
+        message_raw = message.SerializeToString()
+        header = message_pb2.Header()
+        header.message_length = len(message_raw)
+        header_raw = header.SerializeToString()
+
+        return struct.pack("<BB", _record_separator, len(header_raw)) + header_raw + chr(_unit_separator) + message_raw
+
+    sample_ids = frozenset(range(30))
+    fields = ["sampleId", "clientId", None]
+    data = "".join(make_sampled_record(i, fields[i % 3]) for i in range(300))
+    expected = [i for i in range(300) if get_sample_id("client-{}".format(i)) in sample_ids]
+
+    loads = json.loads
+    decoded = []
+    json.loads = lambda payload: decoded.append(payload) or loads(payload)
+
+    try:
+        actual = [ping["meta"]["Timestamp"] for ping in parse_heka_message(StringIO(data), sample_ids=sample_ids)]
+    finally:
+        json.loads = loads
+
+    assert(actual == expected)
+    assert(len(decoded) == len(expected) + sum(1 for i in range(300) if i % 3 == 2 and i not in expected))
+
+    # Top-level fields, e.g. clientId as the pipeline writes it, are meta fields and
+    # don't spare decoding the payload paths with the same name
+    message = message_pb2.Message()
+    message.uuid = struct.pack("<QQ", 0, 0)
+    message.payload = json.dumps({"clientId": "client-0", "info": {"reason": "shutdown"}})
+    message.fields.add(name="clientId", value_string=["client-0"])
+    message.fields.add(name="payload.info", value_string=[json.dumps({"reason": "shutdown"})])
+
+    ping = _parse_heka_record(message, _Projection(["clientId", "meta/Timestamp"]))
+    assert(ping["clientId"] == "client-0" and ping["meta"]["clientId"] == "client-0")
+    assert(not _Projection(["payload/info"]).needs_payload(message.fields))
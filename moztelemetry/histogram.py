@@ -7,14 +7,12 @@
 
 from __future__ import division
 
-import requests
 import histogram_tools
-import re
 import pandas as pd
 import numpy as np
-import ujson as json
 
 from functools32 import lru_cache
+from histogram_registry import get_definition as _get_definition
 
 # Ugly hack to speed-up aggregation.
 exponential_buckets = histogram_tools.exponential_buckets
@@ -31,47 +29,51 @@ def cached_linear_buckets(*args, **kwargs):
 histogram_tools.exponential_buckets = cached_exponential_buckets
 histogram_tools.linear_buckets = cached_linear_buckets
 
-@lru_cache(maxsize=2**10)
-def _fetch_histograms_definition(revision):
-    uri = (revision + "/toolkit/components/telemetry/Histograms.json").replace("rev", "raw-file")
-    definition = requests.get(uri).content
+class Histogram(object):
+    """
+    A class representing a histogram. The bucket counts are held in a NumPy array
+    and the definition is shared by all histograms of the same name and revision,
+    so that millions of histograms can be held in memory; the pandas Series of
+    the buckets is only built when requested.
+    """
 
-    # see bug 920169
-    definition = definition.replace('"JS::gcreason::NUM_TELEMETRY_REASONS"', "101")
-    definition = definition.replace('"mozilla::StartupTimeline::MAX_EVENT_ID"', "12")
-    definition = definition.replace('"80 + 1"', "81")
+    __slots__ = ("definition", "name", "values")
 
-    return json.loads(definition)
+    def __init__(self, name, instance, revision="https://hg.mozilla.org/mozilla-central/rev/tip"):
+        """
+        Initialize a histogram from its name and a telemetry submission.
+        Arrays of 64 bit integers, e.g. aggregates, keep their precision.
+        """
 
-@lru_cache(maxsize=2**20)  # A LFU cache would be more appropriate.
-def _get_cached_ranges(definition):
-    return definition.ranges()
+        self.definition = _get_definition(name, revision)
+        self.name = name
+        self.values = _get_values(self.definition, name, instance)
 
-class Histogram:
-    """ A class representing a histogram. """
+    def __getstate__(self):
+        return self.definition, self.name, self.values
 
-    def __init__(self, name, instance, revision="https://hg.mozilla.org/mozilla-central/rev/tip"):
-        """ Initialize a histogram from its name and a telemetry submission. """
+    def __setstate__(self, state):
+        self.definition, self.name, self.values = state
 
-        histograms_definition = _fetch_histograms_definition(revision)
+    @property
+    def kind(self):
+        return self.definition.kind()
 
-        try:
-            self.definition = histogram_tools.Histogram(name, histograms_definition[name])
-        except KeyError:
-            self.definition = histogram_tools.Histogram(name, histograms_definition[re.sub("^STARTUP_", "", name)])
+    @property
+    def buckets(self):
+        """ The buckets as a pandas Series indexed by their lower bounds, which shares the values. """
+        return pd.Series(self.values, index=self.definition.index, copy=False)
 
-        self.kind = self.definition.kind()
-        self.name = name
+    @buckets.setter
+    def buckets(self, buckets):
+        """ Replaces the bucket counts, e.g. with a Series derived from the buckets. """
+        values = np.asarray(buckets.values if isinstance(buckets, pd.Series) else buckets)
 
-        if isinstance(instance, list) or isinstance(instance, np.ndarray) or isinstance(instance, pd.Series):
-            if len(instance) == self.definition.n_buckets():
-                values = instance
-            else:
-                values = instance[:-5]
-            self.buckets = pd.Series(values, index=self.definition.ranges(), dtype='int32')
-        else:
-            entries = {int(k): v for k, v in instance["values"].items()}
-            self.buckets = pd.Series(entries, index=self.definition.ranges(), dtype='int32').fillna(0)
+        if len(values) != self.definition.n_buckets():
+            raise ValueError("Histogram {} has {} buckets instead of {}".format(self.name, len(values),
+                                                                                 self.definition.n_buckets()))
+
+        self.values = values
 
     def __str__(self):
         """ Returns a string representation of the histogram. """
@@ -88,12 +90,13 @@ class Histogram:
         if not autocast:
             return self.buckets
 
-        if self.kind in ["exponential", "linear", "enumerated", "boolean"]:
+        kind = self.kind
+        if kind in ["exponential", "linear", "enumerated", "boolean"]:
             return self.percentile(50) if only_median else self.buckets
-        elif self.kind == "count":
-            return self.buckets[0]
-        elif self.kind == "flag":
-            return self.buckets[1] == 1
+        elif kind == "count":
+            return self.values[0]
+        elif kind == "flag":
+            return self.values[1] == 1
         else:
             assert(False) # Unsupported histogram kind
 
@@ -106,26 +109,282 @@ class Histogram:
         assert(percentile >= 0 and percentile <= 100)
         assert(self.kind in ["exponential", "linear", "enumerated", "boolean"])
 
-        fraction = percentile/100
-        to_count = fraction*self.buckets.sum()
-        percentile_bucket = 0
+        return get_percentiles(self.values, self.definition.ranges(), percentile)
 
-        for percentile_bucket in range(len(self.buckets)):
-            freq = self.buckets.values[percentile_bucket]
-            if to_count - freq <= 0:
-                break
-            to_count -= freq
+    def percentiles(self, percentiles):
+        """ Returns an array of the given percentiles of the histogram, computed in one pass. """
+        assert(self.kind in ["exponential", "linear", "enumerated", "boolean"])
+        return get_percentiles(self.values, self.definition.ranges(), np.asarray(percentiles))
 
-        if percentile_bucket == len(self.buckets) - 1:
-            return float('nan')
+    def __add__(self, other):
+        # The name of keyed histograms includes the key, the definition's doesn't
+        return _from_values(self.definition, self.name, self.values + other.values)
 
-        percentile_frequency = self.buckets.values[percentile_bucket]
-        percentile_lower_boundary = self.buckets.index[percentile_bucket]
-        width = self.buckets.index[percentile_bucket + 1] - self.buckets.index[percentile_bucket]
-        return percentile_lower_boundary + width*to_count/percentile_frequency
+    def __iadd__(self, other):
+        """
+        Adds the buckets of another histogram in place, unless they need a wider
+        type. Objects sharing the values, e.g. the matrix of a row, see the change.
+        """
+        self.values = _add_values(self.values, other.values)
+        return self
+
+
+class HistogramMatrix(object):
+    """
+    N histograms sharing a definition, stored as the rows of a contiguous 2-D array
+    so that they can be analyzed with vectorized operations.
+
+    Example usage:
+    histograms = pings.map(lambda x: Histogram("GC_MS", x["payload"]["histograms"]["GC_MS"]))
+    matrix = HistogramMatrix.concat(histograms.mapPartitions(HistogramMatrix.from_partition).collect())
+    print matrix.percentiles([25, 50, 75]).mean(axis=0), matrix.sum().get_value()
+    """
+
+    def __init__(self, definition, values, name=None):
+        values = np.asarray(values)
+
+        if values.ndim != 2 or values.shape[1] != definition.n_buckets():
+            raise ValueError("Invalid shape {} for {} buckets".format(values.shape, definition.n_buckets()))
+
+        self.definition = definition
+        self.name = name or definition.name()
+        self.values = values
+
+    @staticmethod
+    def from_histograms(histograms):
+        """ Returns a matrix of a non-empty list of histograms with the same definition. """
+        if not histograms:
+            raise ValueError("A matrix needs at least one histogram")
+
+        first = histograms[0]
+        if any(histogram.definition is not first.definition for histogram in histograms):
+            raise ValueError("Histograms with different definitions can't be stacked")
+
+        dtype = 'int64' if any(histogram.values.dtype == np.int64 for histogram in histograms) else 'int32'
+        return HistogramMatrix(first.definition, np.vstack([h.values for h in histograms]).astype(dtype, copy=False),
+                               first.name)
+
+    @staticmethod
+    def from_partition(histograms):
+        """
+        Stacks the histograms of a RDD partition, skipping None, and yields a matrix
+        per histogram name, e.g.: rdd.mapPartitions(HistogramMatrix.from_partition).
+        """
+        groups = {}
+
+        for histogram in histograms:
+            if histogram is not None:
+                groups.setdefault((histogram.name, histogram.definition), []).append(histogram)
+
+        for group in groups.itervalues():
+            yield HistogramMatrix.from_histograms(group)
+
+    @staticmethod
+    def concat(matrices):
+        """ Concatenates a non-empty list of matrices of the same histogram. """
+        if not matrices:
+            raise ValueError("Nothing to concatenate")
+
+        first = matrices[0]
+        if any(matrix.definition is not first.definition for matrix in matrices):
+            raise ValueError("Matrices with different definitions can't be concatenated")
+
+        return HistogramMatrix(first.definition, np.concatenate([matrix.values for matrix in matrices]), first.name)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, key):
+        """ Returns a row as a Histogram, or a matrix of a slice or mask of rows; both share the values. """
+        if isinstance(key, (int, long, np.integer)):
+            return _from_values(self.definition, self.name, self.values[key])
+
+        return HistogramMatrix(self.definition, self.values[key], self.name)
+
+    def to_histograms(self):
+        """ Returns the rows as a list of Histogram objects, which share the values. """
+        return [_from_values(self.definition, self.name, row) for row in self.values]
+
+    def to_dataframe(self):
+        """ Returns the values as a DataFrame with a column per bucket. """
+        return pd.DataFrame(self.values, columns=self.definition.index)
+
+    def sum(self):
+        """ Returns the sum of the histograms. """
+        return _from_values(self.definition, self.name, self.values.sum(axis=0, dtype="int64"))
+
+    def mean(self):
+        """ Returns the mean count of each bucket. """
+        return self.values.mean(axis=0)
+
+    def normalize(self):
+        """ Returns the rows divided by their totals, NaN for empty histograms. """
+        totals = self.values.sum(axis=1, dtype="int64")[:, None]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.values/totals
+
+    def percentiles(self, percentiles):
+        """ Returns the percentiles of each histogram, see get_percentiles. """
+        return get_percentiles(self.values, self.definition.ranges(), percentiles)
+
+    def sum_by(self, labels):
+        """
+        Sums the histograms by the label of their row. Returns the sorted distinct
+        labels and a matrix with the sum of each group in the same order.
+        """
+        groups, sums, sizes = self._reduce_by(labels)
+        return groups, HistogramMatrix(self.definition, sums, self.name)
+
+    def mean_by(self, labels):
+        """ Like sum_by but returns the mean count of each bucket for each group. """
+        groups, sums, sizes = self._reduce_by(labels)
+        return groups, sums/sizes[:, None].astype("float64")
+
+    def _reduce_by(self, labels):
+        labels = np.asarray(labels)
+
+        if labels.shape != (len(self), ):
+            raise ValueError("Expected a label for each of the {} histograms".format(len(self)))
+
+        groups, inverse = np.unique(labels, return_inverse=True)
+        sizes = np.bincount(inverse, minlength=len(groups))
+
+        if not len(groups):
+            return groups, np.zeros((0, self.values.shape[1]), dtype="int64"), sizes
+
+        # Sum the contiguous runs of rows of each group once sorted by group
+        order = np.argsort(inverse, kind="mergesort")
+        starts = np.append(0, np.cumsum(sizes)[:-1])
+        sums = np.add.reduceat(self.values[order].astype("int64", copy=False), starts, axis=0)
+        return groups, sums, sizes
 
-    def __add__(self, other):
-        return Histogram(self.name, self.buckets + other.buckets)
+
+def get_percentiles(values, ranges, percentiles, block_rows=2**16):
+    """
+    Returns percentiles of the bucket counts of a histogram, or of each row of a 2-D
+    array of histograms sharing the given bucket lower bounds. The result has a
+    trailing dimension for the percentiles if they are given as a sequence, e.g. the
+    medians of N histograms are get_percentiles(matrix, ranges, 50), of shape (N,),
+    and their quartiles get_percentiles(matrix, ranges, [25, 50, 75]), of shape (N, 3).
+
+    A percentile is interpolated linearly within the first bucket whose cumulative
+    count reaches it, and is NaN if that's the last bucket. Bucket counts must be
+    non-negative. Rows are processed in blocks of block_rows to bound the memory used.
+    """
+    values = np.asarray(values)
+    fractions = np.asarray(percentiles, dtype="float64")/100
+
+    if fractions.ndim > 1 or np.any((fractions < 0) | (fractions > 1)):
+        raise ValueError("Invalid percentiles")
+
+    if values.ndim == 1:
+        result = _get_row_percentiles(values, ranges, np.atleast_1d(fractions))
+        return result[0] if fractions.ndim == 0 else result
+
+    result = np.empty((len(values), fractions.size), dtype="float64")
+
+    for start in xrange(0, len(values), block_rows):
+        result[start:start + block_rows] = _get_block_percentiles(values[start:start + block_rows], ranges,
+                                                                  np.atleast_1d(fractions))
+
+    return result[:, 0] if fractions.ndim == 0 else result
+
+
+def _get_row_percentiles(values, ranges, fractions):
+    n_buckets = len(values)
+    cumulative = np.cumsum(values, dtype="int64")
+    targets = fractions*cumulative[-1]
+
+    # The cumulative counts are sorted, as the bucket counts are non-negative
+    buckets = np.minimum(np.searchsorted(cumulative, targets, side="left"), n_buckets - 1)
+    before = np.where(buckets > 0, cumulative[np.maximum(buckets - 1, 0)], 0)
+    to_count = targets - before
+
+    inner = np.minimum(buckets, n_buckets - 2)
+    ranges = np.asarray(ranges)
+    lower = ranges[inner]
+    width = ranges[inner + 1] - lower
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = lower + width*to_count/values[inner]
+
+    result[buckets >= n_buckets - 1] = np.nan
+    return result
+
+
+def _get_block_percentiles(block, ranges, fractions):
+    n_rows, n_buckets = block.shape
+    rows = np.arange(n_rows)[:, None]
+    cumulative = np.cumsum(block, axis=1, dtype="int64")
+    targets = fractions[None, :]*cumulative[:, -1:]
+
+    # The bucket of a percentile is the first one whose cumulative count reaches
+    # it; targets beyond the total end up in the last bucket, like an exhausted walk.
+    buckets = np.empty(targets.shape, dtype="intp")
+    for j in xrange(len(fractions)):
+        reached = cumulative >= targets[:, j:j + 1]
+        buckets[:, j] = np.where(reached[:, -1], reached.argmax(axis=1), n_buckets - 1)
+
+    # The count left to reach within the bucket, i.e. the target minus the counts before it
+    before = np.where(buckets > 0, cumulative[rows, np.maximum(buckets - 1, 0)], 0)
+    to_count = targets - before
+
+    last = buckets >= n_buckets - 1
+    inner = np.minimum(buckets, n_buckets - 2)
+    ranges = np.asarray(ranges)
+    lower = ranges[inner]
+    width = ranges[inner + 1] - lower
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = lower + width*to_count/block[rows, inner]
+
+    result[last] = np.nan
+    return result
+
+
+def _get_values(definition, name, instance):
+    """ Returns a new array of the bucket counts of a telemetry submission. """
+    n_buckets = definition.n_buckets()
+
+    if isinstance(instance, list) or isinstance(instance, np.ndarray) or isinstance(instance, pd.Series):
+        if len(instance) == n_buckets:
+            values = instance
+        else:
+            values = instance[:-5]
+        dtype = 'int64' if getattr(instance, 'dtype', None) == np.int64 else 'int32'
+        values = np.array(values, dtype=dtype)
+
+        if len(values) != n_buckets:
+            raise ValueError("Histogram {} has {} buckets instead of {}".format(name, len(values), n_buckets))
+    else:
+        values = np.zeros(n_buckets, dtype='int32')
+        bucket_index = definition.bucket_index
+
+        for k, v in instance["values"].iteritems():
+            i = bucket_index.get(int(k), None)
+            if i is not None:
+                values[i] = v
+
+    return values
+
+
+def _add_values(total, values):
+    """ Adds values to total in place if its type can hold them, returns the sum. """
+    if np.can_cast(values.dtype, total.dtype):
+        total += values
+        return total
+
+    return total + values
+
+
+def _from_values(definition, name, values):
+    """ Returns a histogram of an array of bucket counts, which isn't copied. """
+    histogram = Histogram.__new__(Histogram)
+    histogram.definition = definition
+    histogram.name = name
+    histogram.values = values
+    return histogram
 
 
 if __name__ == "__main__":
@@ -140,3 +399,76 @@ if __name__ == "__main__":
 
     # Startup histogram
     Histogram("STARTUP_HTTPCONNMGR_USED_SPECULATIVE_CONN", [0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0.693147182464599, 0.480453014373779, -1, -1])
+
+    # Vectorized percentiles match the bucket walk they replace, on random histograms
+    def reference_percentile(values, ranges, percentile):
+        to_count = percentile/100*values.sum()
+        percentile_bucket = 0
+
+        for percentile_bucket in range(len(values)):
+            freq = values[percentile_bucket]
+            if to_count - freq <= 0:
+                break
+            to_count -= freq
+
+        if percentile_bucket == len(values) - 1:
+            return float('nan')
+
+        width = ranges[percentile_bucket + 1] - ranges[percentile_bucket]
+        return ranges[percentile_bucket] + width*to_count/values[percentile_bucket]
+
+    def same(a, b):
+        return np.array_equal(np.isnan(a), np.isnan(b)) and np.array_equal(a[~np.isnan(a)], b[~np.isnan(b)])
+
+    rng = np.random.RandomState(42)
+    tested = [0, 1, 5, 25, 33.3, 50, 75, 95, 99.9, 100]
+
+    for n_buckets in [1, 2, 3, 10, 50]:
+        ranges = np.cumsum(rng.randint(1, 100, n_buckets))
+        matrix = rng.randint(0, 5, (200, n_buckets))*(rng.rand(200, n_buckets) < 0.3)
+        matrix[0] = 0
+
+        batch = get_percentiles(matrix, ranges, tested, block_rows=64)
+        assert batch.shape == (200, len(tested))
+        assert same(get_percentiles(matrix, ranges, 50), batch[:, tested.index(50)])
+
+        for values, row in zip(matrix, batch):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                expected = np.array([reference_percentile(values, ranges, p) for p in tested])
+
+            assert same(expected, row)
+            assert same(get_percentiles(values, ranges, tested), row)
+
+    # Matrices round-trip to histograms and agree with their per-histogram counterparts
+    definition = _get_definition("GC_MS", "https://hg.mozilla.org/mozilla-central/rev/tip")
+    histograms = [Histogram("GC_MS", row) for row in rng.randint(0, 10, (100, definition.n_buckets()))]
+    labels = rng.choice(["beta", "nightly", "release"], len(histograms))
+    matrix = HistogramMatrix.from_histograms(histograms)
+
+    assert all(np.array_equal(a.values, b.values) for a, b in zip(matrix.to_histograms(), histograms))
+    assert np.array_equal(matrix.sum().values, reduce(lambda x, y: x + y, histograms).values)
+    assert same(matrix.percentiles(50), np.array([histogram.percentile(50) for histogram in histograms]))
+    assert np.allclose(matrix.normalize().sum(axis=1), 1)
+
+    groups, sums = matrix.sum_by(labels)
+    for group, total in zip(groups, sums.to_histograms()):
+        assert np.array_equal(total.values, matrix[labels == group].sum().values)
+        assert np.allclose(matrix.mean_by(labels)[1][list(groups).index(group)], matrix[labels == group].mean())
+
+    parts = list(HistogramMatrix.from_partition(histograms[:40] + [None])) + [matrix[40:]]
+    assert np.array_equal(HistogramMatrix.concat(parts).values, matrix.values)
+
+    # In-place additions match additions, and widen the counts when needed
+    total = Histogram("GC_MS", histograms[0].values)
+    for histogram in histograms[1:]:
+        total += histogram
+    assert np.array_equal(total.values, matrix.sum().values)
+
+    total = Histogram("GC_MS", histograms[0].values)
+    total += Histogram("GC_MS", np.full(definition.n_buckets(), 2**40, dtype="int64"))
+    assert total.values.dtype == np.int64 and total.values[0] == histograms[0].values[0] + 2**40
+
+    # The buckets can still be assigned
+    histogram = Histogram("GC_MS", [1]*definition.n_buckets())
+    histogram.buckets = histogram.buckets*3
+    assert((histogram.values == 3).all() and (histogram.buckets == 3).all())
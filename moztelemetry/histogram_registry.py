@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Precompiled histogram definitions.
+
+A registry holds the definitions of one revision of Histograms.json, with the
+kind, bucket count and bucket ranges of every histogram computed once. Names
+with a STARTUP_ prefix resolve to the definition of the histogram without it.
+Looking up a histogram whose definition histogram_tools rejects raises a
+ValueError with the reason, rather than the KeyError of unknown histograms.
+
+The definitions are read from MOZTELEMETRY_HISTOGRAMS if set, which is either
+a Histograms.json file used for every revision or a directory of files named
+after the revisions they belong to, e.g. "da2f28836843.json", falling back to
+"Histograms.json" in that directory; they are fetched from hg.mozilla.org
+otherwise. Setting MOZTELEMETRY_HISTOGRAMS_CACHE_DIR persists the compiled
+registries, so that workers don't compile or download them again. Downloaded
+definitions of a moving revision, e.g. tip, are never persisted.
+
+Example usage:
+set_definitions_path("/mnt/telemetry/Histograms.json")
+definition = get_definition("GC_MS", "https://hg.mozilla.org/mozilla-central/rev/tip")
+print definition.kind(), definition.n_buckets(), definition.ranges()
+"""
+
+import cPickle as pickle
+import errno
+import hashlib
+import histogram_tools
+import numpy as np
+import os
+import pandas as pd
+import re
+import requests
+import tempfile
+import ujson as json
+
+from functools32 import lru_cache
+
+_cache_version = 2
+_startup_prefix = "STARTUP_"
+
+
+class HistogramDefinition(object):  # New-style, as pickle ignores the __reduce__ of classic instances
+    """
+    A compiled histogram definition. The kind, bounds and ranges are precomputed, the
+    other accessors of histogram_tools.Histogram, e.g. keyed() or description(), are
+    delegated to one built on first use. Definitions are interned per registry and
+    unpickle to the interned instance.
+    """
+
+    def __init__(self, name, revision, kind, low, high, n_buckets, ranges, definition):
+        self._name = name
+        self._revision = revision
+        self._kind = kind
+        self._low = low
+        self._high = high
+        self._n_buckets = n_buckets
+        self._ranges = ranges
+        self._ranges.flags.writeable = False  # Shared by all histograms of the definition
+        self._definition = definition
+        self._histogram = None
+        self._index = None
+        self._bucket_index = None
+
+    def __reduce__(self):
+        return (get_definition, (self._name, self._revision))
+
+    def __getattr__(self, attribute):
+        # Only called for attributes that aren't defined above
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+
+        if self._histogram is None:
+            self._histogram = histogram_tools.Histogram(self._name, self._definition)
+
+        return getattr(self._histogram, attribute)
+
+    def name(self):
+        return self._name
+
+    def kind(self):
+        return self._kind
+
+    def low(self):
+        return self._low
+
+    def high(self):
+        return self._high
+
+    def n_buckets(self):
+        return self._n_buckets
+
+    def ranges(self):
+        """ Returns the lower bounds of the buckets as a read-only int64 array. """
+        return self._ranges
+
+    @property
+    def index(self):
+        """ The ranges as a pandas Index, shared by the histograms of this definition. """
+        if self._index is None:
+            self._index = pd.Index(self._ranges)
+        return self._index
+
+    @property
+    def bucket_index(self):
+        """ A dictionary from the lower bound of each bucket to its position. """
+        if self._bucket_index is None:
+            self._bucket_index = {int(bucket): i for i, bucket in enumerate(self._ranges)}
+        return self._bucket_index
+
+
+class DefinitionRegistry:
+    def __init__(self, revision, compiled, errors={}):
+        """
+        Initialize a registry from the output of compile_definitions. Definitions
+        of aliases share the ranges of the histogram they refer to.
+        """
+        self.revision = revision
+        self._definitions = {name: HistogramDefinition(name, revision, *spec) for name, spec in compiled.iteritems()}
+        self._errors = dict(errors)
+
+        for name, spec in compiled.iteritems():
+            alias = _startup_prefix + name
+            if alias not in self._definitions:
+                self._definitions[alias] = HistogramDefinition(alias, revision, *spec)
+
+        for name, error in errors.iteritems():
+            alias = _startup_prefix + name
+            if alias not in self._definitions:
+                self._errors.setdefault(alias, error)
+
+    def __getitem__(self, name):
+        try:
+            return self._definitions[name]
+        except KeyError:
+            if name in self._errors:
+                raise ValueError("Invalid definition of histogram {}: {}".format(name, self._errors[name]))
+            raise
+
+    def __contains__(self, name):
+        return name in self._definitions
+
+    def __len__(self):
+        return len(self._definitions)
+
+    def names(self):
+        return self._definitions.keys()
+
+
+def set_definitions_path(path=None, cache_dir=None):
+    """
+    Sets the file or directory the definitions are read from and the directory
+    compiled registries are persisted to. The settings are stored in the environment
+    so that worker processes spawned afterwards inherit them. Passing None restores
+    the default, i.e. fetching the definitions and not persisting them.
+    """
+    for name, value in (("MOZTELEMETRY_HISTOGRAMS", path), ("MOZTELEMETRY_HISTOGRAMS_CACHE_DIR", cache_dir)):
+        if value:
+            os.environ[name] = value
+        else:
+            os.environ.pop(name, None)
+
+    get_registry.cache_clear()
+
+
+def get_definition(name, revision):
+    """
+    Returns the definition of a histogram, raising a KeyError for unknown names and
+    a ValueError for histograms whose definition couldn't be compiled.
+    """
+    return get_registry(revision)[name]
+
+
+@lru_cache(maxsize=2**10)
+def get_registry(revision):
+    """ Returns the registry of a revision, loading it from the persisted ones if possible. """
+    source = _find_source(revision)
+    cache_dir = os.environ.get("MOZTELEMETRY_HISTOGRAMS_CACHE_DIR")
+
+    if source:
+        stat = os.stat(source)
+        identity = "{}:{}:{}".format(os.path.abspath(source), stat.st_mtime, stat.st_size)
+    elif _is_pinned(revision):
+        identity = revision
+    else:
+        identity = None
+
+    cache_path = None
+    if cache_dir and identity:
+        digest = hashlib.sha1("{}:{}".format(_cache_version, identity)).hexdigest()
+        cache_path = os.path.join(cache_dir, digest + ".pickle")
+
+    result = _load_compiled(cache_path) if cache_path else None
+
+    if result is None:
+        if source:
+            with open(source, "rb") as f:
+                definitions = _parse_histograms_definition(f.read())
+        else:
+            definitions = _fetch_histograms_definition(revision)
+
+        result = compile_definitions(definitions)
+
+        if cache_path:
+            _store_compiled(cache_path, result)
+
+    compiled, errors = result
+    return DefinitionRegistry(revision, compiled, errors)
+
+
+def compile_definitions(definitions):
+    """
+    Returns the kind, low, high, bucket count, ranges and raw definition of each
+    histogram of a parsed Histograms.json, along with the errors of the histograms
+    whose definitions histogram_tools rejects.
+    """
+    compiled = {}
+    errors = {}
+
+    for name, definition in definitions.iteritems():
+        try:
+            histogram = histogram_tools.Histogram(name, definition)
+            ranges = np.array(histogram.ranges(), dtype="int64")
+            compiled[name] = (histogram.kind(), histogram.low(), histogram.high(), histogram.n_buckets(), ranges,
+                              definition)
+        except Exception as e:
+            errors[name] = "{}: {}".format(type(e).__name__, e)
+
+    return compiled, errors
+
+
+def _find_source(revision):
+    path = os.environ.get("MOZTELEMETRY_HISTOGRAMS")
+
+    if not path:
+        return None
+    elif not os.path.isdir(path):
+        return path
+
+    for name in (revision.rstrip("/").split("/")[-1] + ".json", "Histograms.json"):
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate):
+            return candidate
+
+    return None
+
+
+def _is_pinned(revision):
+    return re.match("^[0-9a-f]{12,40}$", revision.rstrip("/").split("/")[-1]) is not None
+
+
+def _fetch_histograms_definition(revision):
+    uri = (revision + "/toolkit/components/telemetry/Histograms.json").replace("rev", "raw-file")
+    return _parse_histograms_definition(requests.get(uri).content)
+
+
+def _parse_histograms_definition(definition):
+    # see bug 920169
+    definition = definition.replace('"JS::gcreason::NUM_TELEMETRY_REASONS"', "101")
+    definition = definition.replace('"mozilla::StartupTimeline::MAX_EVENT_ID"', "12")
+    definition = definition.replace('"80 + 1"', "81")
+
+    return json.loads(definition)
+
+
+def _load_compiled(path):
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except (EOFError, pickle.UnpicklingError, ValueError):
+        pass  # Written by an incompatible version, it's compiled again
+
+    return None
+
+
+def _store_compiled(path, compiled):
+    directory = os.path.dirname(path)
+
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Registries can be persisted by several workers at once
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+
+    os.rename(tmp_path, path)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" A Spark-free execution backend, on top of a local process pool.
+
+LocalContext and LocalRDD implement the subset of the SparkContext and RDD APIs
+used by the Telemetry API, so that small analyses can run without starting
+Spark. Transformations are chained lazily into a function per partition; each
+action forks a pool of worker processes which inherit the pipeline, so that
+closures don't have to be pickled, and only the results are sent back.
+
+Example usage:
+sc = LocalContext()
+pings = get_pings(sc, app="Firefox", channel="nightly", submission_date="20150601", fraction=0.01)
+print get_one_ping_per_client(pings).count()
+
+get_pings(None, ...) uses a LocalContext as well.
+"""
+
+import copy
+import itertools
+import multiprocessing
+
+_job = None  # The (rdd, task, accumulators) run by the workers, inherited when they are forked
+
+
+class LocalContext:
+    """ A stand-in for SparkContext which runs jobs in a pool of processes. """
+
+    def __init__(self, processes=None):
+        self.defaultParallelism = processes or multiprocessing.cpu_count()
+        self._accumulators = []
+
+    def parallelize(self, data, numSlices=None):
+        n_slices = max(min(numSlices or self.defaultParallelism, len(data)), 1)
+        bounds = [(len(data)*i/n_slices, len(data)*(i + 1)/n_slices) for i in range(n_slices)]
+        return LocalRDD(self, [(data, start, end) for start, end in bounds])
+
+    def broadcast(self, value):
+        return _Broadcast(value)
+
+    def accumulator(self, value):
+        accumulator = LocalAccumulator(value)
+        self._accumulators.append(accumulator)
+        return accumulator
+
+    def _run(self, rdd, task):
+        """ Returns the results of a task over all partitions of a RDD, in order. """
+        global _job
+
+        n_partitions = rdd.getNumPartitions()
+        processes = min(self.defaultParallelism, n_partitions)
+
+        if processes <= 1:
+            return [task(rdd._compute(i)) for i in range(n_partitions)]
+
+        _job = (rdd, task, self._accumulators)
+        pool = multiprocessing.Pool(processes)
+
+        try:
+            results = []
+
+            for result, deltas in pool.imap(_run_task, range(n_partitions)):
+                for accumulator, delta in zip(self._accumulators, deltas):
+                    accumulator.add(delta)
+                results.append(result)
+
+            pool.close()
+            return results
+        finally:
+            pool.terminate()
+            pool.join()
+            _job = None
+
+
+def _run_task(index):
+    rdd, task, accumulators = _job
+
+    # Accumulators are reset in the workers, so that only their updates are sent back
+    for accumulator in accumulators:
+        accumulator.value = accumulator.zero
+
+    result = task(rdd._compute(index))
+    return result, [accumulator.value for accumulator in accumulators]
+
+
+class LocalRDD:
+    """ A stand-in for RDD, made of the slices of a sequence and a function applied to each slice. """
+
+    def __init__(self, context, slices, fn=None):
+        self.context = context
+        self._slices = slices
+        self._fn = fn or (lambda index, iterator: iterator)
+
+    def getNumPartitions(self):
+        return len(self._slices)
+
+    def cache(self):
+        return self
+
+    def unpersist(self, blocking=False):
+        return self
+
+    def mapPartitionsWithIndex(self, f, preservesPartitioning=False):
+        fn = self._fn
+        return LocalRDD(self.context, self._slices, lambda index, iterator: f(index, fn(index, iterator)))
+
+    def mapPartitions(self, f, preservesPartitioning=False):
+        return self.mapPartitionsWithIndex(lambda index, iterator: f(iterator))
+
+    def map(self, f):
+        return self.mapPartitions(lambda iterator: itertools.imap(f, iterator))
+
+    def flatMap(self, f):
+        return self.mapPartitions(lambda iterator: itertools.chain.from_iterable(itertools.imap(f, iterator)))
+
+    def filter(self, f):
+        return self.mapPartitions(lambda iterator: itertools.ifilter(f, iterator))
+
+    def reduceByKey(self, func, numPartitions=None):
+        n_partitions = numPartitions or self.getNumPartitions()
+
+        def combine(iterator):
+            # Values are combined within each partition first, and then split by key hash
+            combined = {}
+            for key, value in iterator:
+                combined[key] = func(combined[key], value) if key in combined else value
+
+            buckets = [[] for _ in range(n_partitions)]
+            for key, value in combined.iteritems():
+                buckets[hash(key) % n_partitions].append((key, value))
+            return buckets
+
+        merged = [{} for _ in range(n_partitions)]
+        for buckets in self.context._run(self, combine):
+            for partition, bucket in zip(merged, buckets):
+                for key, value in bucket:
+                    partition[key] = func(partition[key], value) if key in partition else value
+
+        return LocalRDD(self.context, [(partition.items(), 0, len(partition)) for partition in merged])
+
+    def treeAggregate(self, zeroValue, seqOp, combOp, depth=2):
+        return self.aggregate(zeroValue, seqOp, combOp)
+
+    def aggregate(self, zeroValue, seqOp, combOp):
+        partials = self.context._run(self, lambda iterator: reduce(seqOp, iterator, copy.deepcopy(zeroValue)))
+        return reduce(combOp, partials, copy.deepcopy(zeroValue))
+
+    def reduce(self, f):
+        partials = self.context._run(self, lambda iterator: list(itertools.islice(_reduce(f, iterator), 1)))
+        return reduce(f, itertools.chain.from_iterable(partials))
+
+    def collect(self):
+        return list(itertools.chain.from_iterable(self.context._run(self, list)))
+
+    def count(self):
+        return sum(self.context._run(self, lambda iterator: sum(1 for _ in iterator)))
+
+    def take(self, num):
+        # Partitions are computed in this process, one at a time, until enough elements are found
+        return list(itertools.islice(self.toLocalIterator(), num))
+
+    def first(self):
+        result = self.take(1)
+        if not result:
+            raise ValueError("RDD is empty")
+        return result[0]
+
+    def toLocalIterator(self):
+        for index in range(self.getNumPartitions()):
+            for element in self._compute(index):
+                yield element
+
+    def _compute(self, index):
+        data, start, end = self._slices[index]
+
+        if isinstance(data, xrange):
+            iterator = itertools.islice(data, start, end)
+        else:
+            iterator = iter(data[start:end])
+
+        return self._fn(index, iterator)
+
+
+def _reduce(f, iterator):
+    # Yields the reduction of a partition, or nothing if it's empty
+    iterator = iter(iterator)
+
+    for first in iterator:
+        yield reduce(f, iterator, first)
+
+
+class LocalAccumulator:
+    """ A stand-in for Spark's numeric accumulators. """
+
+    def __init__(self, value):
+        self.value = value
+        self.zero = type(value)()
+
+    def add(self, term):
+        self.value += term
+
+    def __iadd__(self, term):
+        self.add(term)
+        return self
+
+
+class _Broadcast:
+    def __init__(self, value):
+        self.value = value
+
+    def unpersist(self, blocking=False):
+        pass
+
+
+if __name__ == "__main__":
+    # Jobs run in this process or in a pool of workers return the same results
+    for processes in (1, 3):
+        sc = LocalContext(processes)
+        data = range(100)
+        rdd = sc.parallelize(data, 7)
+
+        assert(rdd.getNumPartitions() == 7)
+        assert(rdd.collect() == data)
+        assert(sc.parallelize(xrange(100), 7).collect() == data)
+        assert(rdd.map(lambda x: x*2).filter(lambda x: x % 3).collect() == [x*2 for x in data if x*2 % 3])
+        assert(rdd.flatMap(lambda x: [x]*(x % 3)).count() == sum(x % 3 for x in data))
+        assert(rdd.mapPartitionsWithIndex(lambda i, x: [i]*len(list(x))).collect() ==
+               [max(i for i in range(7) if 100*i/7 <= x) for x in data])
+
+        pairs = rdd.map(lambda x: (x % 10, x)).reduceByKey(lambda x, y: x + y, 4)
+        assert(pairs.getNumPartitions() == 4)
+        assert(sorted(pairs.collect()) == [(k, sum(x for x in data if x % 10 == k)) for k in range(10)])
+
+        assert(rdd.aggregate([], lambda x, y: x + [y], lambda x, y: x + y) == data)
+        assert(rdd.treeAggregate(0, lambda x, y: x + y, lambda x, y: x + y) == sum(data))
+        assert(rdd.filter(lambda x: x > 90).reduce(max) == 99)  # Most partitions are empty
+        assert(rdd.take(3) == [0, 1, 2] and rdd.first() == 0)
+
+        try:
+            rdd.filter(lambda x: False).first()
+            assert(False)
+        except ValueError:
+            pass
+
+        # Accumulators are updated from the workers, broadcasts are read from them
+        accumulator = sc.accumulator(0)
+        offset = sc.broadcast(1000)
+        assert(rdd.map(lambda x: accumulator.add(1) or x + offset.value).collect() == [x + 1000 for x in data])
+        assert(accumulator.value == 100)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Opt-in instrumentation of the stages of a get_pings pipeline.
+
+Each stage accounts for the bytes and records it processed, the errors it hit
+and the wall and CPU time it spent. Stages nest: e.g. the S3 reads triggered
+while framing heka records are accounted to the transfer stage only, so that
+the times of the stages add up. The counters are backed by Spark accumulators
+when a SparkContext is available, so that they are reported back to the
+driver, and by plain counters otherwise.
+
+CPU times are those of the whole process, as Python 2 can't measure the CPU
+time of a thread; they are inflated for stages that run concurrently, e.g.
+the reads that are prefetched while v2 files are decompressed.
+
+Example usage:
+pings = get_pings(sc, app="Firefox", channel="nightly", submission_date="20150601", metrics=True)
+properties = get_pings_properties(pings, ["clientId", "payload/histograms/GC_MS"])
+properties.count()
+print pings.metrics.summary()
+"""
+
+import threading
+import time
+
+STAGES = ("index", "listing", "transfer", "decompression", "framing", "decoding", "extraction")
+MEASURES = ("bytes", "records", "errors", "wall", "cpu")
+
+
+class PipelineMetrics:
+    def __init__(self, sc=None):
+        self._counters = {}
+
+        for stage in STAGES:
+            for measure in MEASURES:
+                zero = 0.0 if measure in ("wall", "cpu") else 0
+                self._counters[(stage, measure)] = sc.accumulator(zero) if sc else _Counter(zero)
+
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {"_counters": self._counters}
+
+    def __setstate__(self, state):
+        self._counters = state["_counters"]
+        self._local = threading.local()
+
+    def start(self, stage):
+        """ Starts timing a stage, pausing the stage it's nested in if any. """
+        stack = self._stack()
+        now = (time.time(), time.clock())
+
+        if stack:
+            self._charge(stack[-1], now)
+
+        stack.append([stage, now])
+
+    def stop(self, bytes=0, records=0, errors=0):
+        """ Stops timing the current stage and adds the given counts to it. """
+        stack = self._stack()
+        now = (time.time(), time.clock())
+        entry = stack.pop()
+        self._charge(entry, now)
+
+        stage = entry[0]
+        if bytes:
+            self._counters[(stage, "bytes")].add(bytes)
+        if records:
+            self._counters[(stage, "records")].add(records)
+        if errors:
+            self._counters[(stage, "errors")].add(errors)
+
+        if stack:
+            stack[-1][1] = now
+
+    def add(self, stage, measure, value=1):
+        self._counters[(stage, measure)].add(value)
+
+    def report(self):
+        """ Returns the counters by stage, this only works on the driver. """
+        return {stage: {measure: self._counters[(stage, measure)].value for measure in MEASURES} for stage in STAGES}
+
+    def summary(self):
+        """ Returns the counters as a table, this only works on the driver. """
+        report = self.report()
+        lines = ["{:<14} {:>12} {:>10} {:>7} {:>9} {:>9}".format("stage", "MB", "records", "errors", "wall (s)", "cpu (s)")]
+
+        for stage in STAGES:
+            counters = report[stage]
+            lines.append("{:<14} {:>12.1f} {:>10} {:>7} {:>9.2f} {:>9.2f}".format(
+                stage, counters["bytes"]/2.0**20, counters["records"], counters["errors"], counters["wall"], counters["cpu"]))
+
+        return "\n".join(lines)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def _charge(self, entry, now):
+        stage, (wall, cpu) = entry
+        self._counters[(stage, "wall")].add(now[0] - wall)
+        self._counters[(stage, "cpu")].add(now[1] - cpu)
+        entry[1] = now
+
+
+class _Counter:
+    def __init__(self, value=0):
+        self.value = value
+
+    def add(self, value):
+        self.value += value
+
+
+class MeteredStream:
+    """ A file-like object that accounts the reads of a stream to the transfer stage. """
+
+    def __init__(self, stream, metrics):
+        self._stream = stream
+        self._metrics = metrics
+
+    def read(self, size=-1):
+        self._metrics.start("transfer")
+
+        try:
+            data = self._stream.read(size)
+        except:
+            self._metrics.stop(errors=1)
+            raise
+
+        self._metrics.stop(bytes=len(data))
+        return data
+
+    def close(self):
+        self._stream.close()
+
+
+def metered(iterable, metrics, stage):
+    """ Accounts the time spent producing the elements of an iterable to a stage, one record each. """
+    iterator = iter(iterable)
+
+    while True:
+        metrics.start(stage)
+
+        try:
+            element = next(iterator)
+        except StopIteration:
+            metrics.stop()
+            return
+        except:
+            metrics.stop(errors=1)
+            raise
+
+        metrics.stop(records=1)
+        yield element
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Executor-local, on-disk cache for S3 objects.
+
+Entries are keyed by bucket, object key, ETag and byte range, and are evicted
+in least-recently-used order once the cache exceeds its byte budget. Partial
+entries, left by consumers that stopped reading early, are extended as they are
+read further and become complete entries once the end of the object is reached.
+The cache can be shared by all Python workers of a node: entries are written to
+temporary files and atomically renamed, and evictions are serialized with a file
+lock. Each process keeps an estimate of the size of the cache, so that the cache
+directory is only scanned when the estimate exceeds the budget, or once in a while
+to account for the entries written by other processes.
+
+Example usage:
+cache = ObjectCache("/mnt/moztelemetry-cache", max_bytes=50*2**30)
+stream = cache.open(bucket.get_key("some/key"), start=2**24)
+data = stream.read(1024)
+stream.close()
+print cache.stats()
+
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from s3_reader import open_key
+
+_stale_seconds = 6*60*60
+_scan_seconds = 60  # Longest interval between two scans of the cache directory
+
+
+class ObjectCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._stats = {"hits": 0, "misses": 0, "hit_bytes": 0, "miss_bytes": 0, "evicted_bytes": 0}
+        self._size = None  # Estimated size of the entries, unknown until the first scan
+        self._last_scan = 0
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def open(self, key, start=0, length_hint=None, stats=None, end=None):
+        """
+        Returns a file-like object that reads the given key from the given offset.
+        The length_hint, e.g. the chunk size of a ranged read, becomes part of the
+        cache key as consumers might stop reading at different offsets. Reads from
+        S3 are resumable and accounted in the optional ReadStats, and are bounded
+        by end if set, see s3_reader.open_key.
+        """
+        digest = self._digest(key, start, length_hint)
+
+        for complete in (True, False):
+            path = self._entry_path(digest, complete)
+
+            try:
+                entry = open(path, "rb")
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+
+            try:
+                os.utime(path, None)  # Keep track of the last access for the LRU eviction
+            except OSError:
+                pass  # The entry has just been evicted, but it's still open
+
+            self._stats["hits"] += 1
+            return _CachedObject(self, entry, key, start, digest, complete, stats, end)
+
+        self._stats["misses"] += 1
+        return _CachingObject(self, key, start, digest, stats, end)
+
+    def stats(self):
+        """ Returns the hit/miss counters of this process. """
+        return dict(self._stats)
+
+    def _digest(self, key, start, length_hint):
+        etag = (key.etag or "").strip('"')
+        identity = "{}/{}:{}:{}:{}".format(key.bucket.name, key.name, etag, start, length_hint)
+        return hashlib.sha1(identity).hexdigest()
+
+    def _entry_path(self, digest, complete):
+        return os.path.join(self.path, digest + (".full" if complete else ".part"))
+
+    def _commit(self, tmp_path, digest, complete):
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, self._entry_path(digest, complete))
+
+        if complete:  # A complete entry supersedes the partial one
+            _remove(self._entry_path(digest, False))
+
+        if self._size is not None:
+            self._size += size
+
+        if self._size is None or self._size > self.max_bytes or time.time() - self._last_scan > _scan_seconds:
+            self._evict()
+
+    def _evict(self):
+        with open(os.path.join(self.path, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._last_scan = time.time()
+
+            entries = []
+            now = time.time()
+
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # Evicted by another process
+
+                if name.startswith(".tmp-"):
+                    if now - stat.st_mtime > _stale_seconds:  # Left behind by a dead worker
+                        _remove(path)
+                elif not name.startswith("."):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = self._size = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return
+
+            # Evict a bit more than needed so that evictions don't happen on every write
+            for mtime, size, path in sorted(entries):
+                if total <= 0.9*self.max_bytes:
+                    break
+
+                if _remove(path):
+                    total -= size
+                    self._stats["evicted_bytes"] += size
+
+            self._size = total
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+class _CachedObject:
+    """
+    Reads an object from a cache entry. Partial entries are continued from S3, and
+    the entry is replaced by one which includes the bytes read from S3.
+    """
+
+    def __init__(self, cache, entry, key, start, digest, complete, stats, end):
+        self._cache = cache
+        self._entry = entry
+        self._key = key
+        self._offset = start
+        self._digest = digest
+        self._complete = complete
+        self._stats = stats
+        self._end = end
+        self._remote = None
+
+    def read(self, size=-1):
+        if self._remote is None:
+            data = self._entry.read(size)
+            self._offset += len(data)
+            self._cache._stats["hit_bytes"] += len(data)
+
+            if self._complete or (size >= 0 and len(data) == size):
+                return data
+
+            self._entry.seek(0)
+            self._remote = _CachingObject(self._cache, self._key, self._offset, self._digest, self._stats, self._end,
+                                          self._entry)
+            size = size - len(data) if size >= 0 else size
+        else:
+            data = ""
+
+        return data + self._remote.read(size)
+
+    def close(self):
+        self._entry.close()
+
+        if self._remote is not None:
+            self._remote.close()
+
+
+class _CachingObject:
+    """
+    Reads an object from S3 while writing the consumed bytes to a new cache entry,
+    after those of the partial entry being continued, if any.
+    """
+
+    def __init__(self, cache, key, start, digest, stats, end, prefix=None):
+        self._cache = cache
+        self._key = open_key(key, start, stats, end)
+        self._digest = digest
+        self._failed = False
+        self._closed = False
+        self._eof = False
+
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.path, prefix=".tmp-")
+        self._tmp = os.fdopen(fd, "wb")
+
+        if prefix is not None:
+            shutil.copyfileobj(prefix, self._tmp)
+
+    def read(self, size=-1):
+        try:
+            data = self._key.read(size)
+        except:
+            # Entries of interrupted reads are never committed
+            self._failed = True
+            self._tmp.close()
+            os.remove(self._tmp_path)
+            raise
+
+        if size < 0 or (size > 0 and not data):
+            self._eof = True
+
+        self._tmp.write(data)
+        self._cache._stats["miss_bytes"] += len(data)
+        return data
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._key.close()
+
+        if not self._failed:
+            self._tmp.close()
+            self._cache._commit(self._tmp_path, self._digest, self._eof)
+
+
+if __name__ == "__main__":
+    import re
+    import s3_reader
+    import shutil
+    import socket
+
+    class Bucket:
+        name = "bucket"
+
+    class Key:
+        """ A key served from memory, which can be made to fail its reads. """
+
+        def __init__(self, name, data, etag="etag", fail=False):
+            self.bucket = Bucket()
+            self.name = name
+            self.data = data
+            self.etag = '"{}"'.format(etag)
+            self.size = len(data)
+            self.resp = None
+            self.requested = 0
+            self._fail = fail
+
+        def open_read(self, headers={}):
+            self._position = int(re.match(r"bytes=(\d+)-", headers.get("Range", "bytes=0-")).group(1))
+
+        def read(self, size=0):
+            if self._fail:
+                raise socket.timeout("timed out")
+
+            end = self.size if size == 0 else min(self._position + size, self.size)
+            data = self.data[self._position:end]
+            self.requested += len(data)
+            self._position = end
+            return data
+
+        def close(self, fast=False):
+            pass
+
+    def read(cache, key, start=0, size=-1):
+        stream = cache.open(key, start)
+        data = stream.read(size)
+        stream.close()
+        return data
+
+    path = tempfile.mkdtemp()
+    s3_reader._max_retries = 0
+    data = "".join(chr(i % 251) for i in range(1000))
+
+    try:
+        cache = ObjectCache(path, max_bytes=10000)
+
+        # Entries are keyed by object, etag and offset
+        a = Key("a", data)
+        assert(read(cache, a, 10) == data[10:] and read(cache, a, 10) == data[10:])
+        assert(a.requested == 990)
+        assert(read(cache, Key("a", data, etag="changed"), 10) == data[10:])
+        assert(cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2)
+
+        # Partial entries are continued from S3 and become complete entries
+        b = Key("b", data)
+        assert(read(cache, b, size=300) == data[:300])
+        assert(read(cache, b, size=500) == data[:500] and b.requested == 500)
+        assert(read(cache, b) == data and b.requested == 1000)
+        assert(read(cache, b) == data and b.requested == 1000)
+        assert(not any(name.endswith(".part") for name in os.listdir(path)))
+
+        # Interrupted reads aren't committed
+        try:
+            read(cache, Key("c", data, fail=True))
+            assert(False)
+        except socket.timeout:
+            pass
+
+        assert(not any(name.startswith(".tmp-") for name in os.listdir(path)))
+
+        # The least recently used entries are evicted once the budget is exceeded
+        cache = ObjectCache(path, max_bytes=3500)
+        for i, name in enumerate(sorted(os.listdir(path))):
+            if not name.startswith("."):
+                os.utime(os.path.join(path, name), (i, i))
+
+        first = Key("a", data)
+        assert(read(cache, first, 10) == data[10:] and first.requested == 0)  # The entry is used again
+        assert(read(cache, Key("d", data)) == data)
+        assert(cache.stats()["evicted_bytes"] > 0)
+
+        size = lambda: sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name[0] != ".")
+        assert(size() <= 0.9*cache.max_bytes)
+
+        first = Key("a", data)
+        assert(read(cache, first, 10) == data[10:] and first.requested == 0)
+
+        # The cache is only scanned again once its estimated size exceeds the budget
+        last_scan = cache._last_scan
+        read(cache, Key("e", data[:100]))
+        assert(cache._last_scan == last_scan and cache._size == size())
+        read(cache, Key("f", data))
+        assert(cache._last_scan > last_scan and size() <= 0.9*cache.max_bytes)
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+""" Resumable reads of S3 objects.
+
+Keys can be read up to a given offset with a bounded ranged request, which is
+continued by further ranges of increasing size if more is read. A read
+interrupted by a transient error, e.g. a socket timeout, is resumed with a
+ranged request from the last byte consumed, with a bounded number of retries
+and an exponential backoff. The retried and abandoned bytes are counted in a
+ReadStats object, which is backed by Spark accumulators when a SparkContext is
+available so that the counters are reported back to the driver.
+
+Example usage:
+stats = ReadStats(sc)
+stream = open_key(bucket.get_key("some/key"), start=1024, stats=stats, end=2048)
+data = stream.read(4096)
+stream.close()
+print stats.value()
+
+"""
+
+import httplib
+import socket
+import time
+
+from boto.exception import BotoServerError
+
+# ssl.SSLError is a subclass of socket.error
+TRANSIENT_ERRORS = (socket.error, httplib.HTTPException)
+
+_max_retries = 5
+_continuation_size = 2**18  # Size of the first range requested past the end of a bounded read
+_retry_backoff = 0.5  # Seconds, doubled at each retry
+
+
+class ReadStats:
+    """
+    Counters of the S3 reads that had to be retried or were abandoned, and of the
+    records that were skipped by a record filter.
+    """
+
+    names = ("retries", "retried_bytes", "abandoned_reads", "abandoned_bytes", "filtered_records")
+
+    def __init__(self, sc=None):
+        self._counters = {name: sc.accumulator(0) if sc else _Counter() for name in self.names}
+
+    def add(self, name, value=1):
+        self._counters[name].add(value)
+
+    def value(self):
+        """ Returns the counters as a dictionary, this only works on the driver. """
+        return {name: counter.value for name, counter in self._counters.iteritems()}
+
+
+class _Counter:
+    def __init__(self):
+        self.value = 0
+
+    def add(self, value):
+        self.value += value
+
+
+def get_key(bucket, name, stats=None):
+    """ Returns the key of an object, retrying on transient errors. """
+    return _retry(lambda: bucket.get_key(name), stats)
+
+
+def open_key(key, start=0, stats=None, end=None):
+    """
+    Returns a ResumableReader for the key, reading from the given offset. If end is
+    set, only the bytes up to that offset are requested at first.
+    """
+    return ResumableReader(key, start, stats, end)
+
+
+class ResumableReader:
+    """
+    A file-like object that reads a key and resumes interrupted reads with a ranged request.
+    Bounded reads are continued with ranges that double in size, starting at _continuation_size.
+    """
+
+    def __init__(self, key, start=0, stats=None, end=None):
+        self._key = key
+        self._offset = start
+        self._stats = stats
+        self._range_end = end
+        self._range_size = _continuation_size
+        self._opened = False
+        self._resumed = False
+        self._eof = False
+
+    def read(self, size=-1):
+        attempt = 0
+
+        if self._range_end is not None and size < 0:
+            return "".join(iter(lambda: self.read(_continuation_size), ""))
+
+        # boto would otherwise re-open the key from its first byte
+        if self._eof or size == 0:
+            return ""
+
+        if self._range_end is not None:
+            if self._offset >= self._range_end:
+                self._next_range()
+
+            if self._eof:
+                return ""
+
+            size = min(size, self._range_end - self._offset)
+
+        while True:
+            try:
+                if attempt or not self._opened:
+                    self._close()
+                    self._open()
+
+                data = self._key.read(size if size > 0 else 0)  # boto reads everything with size 0
+                break
+            except TRANSIENT_ERRORS + (BotoServerError, ) as e:
+                if getattr(e, "status", None) == 416:  # A range past the end of the key
+                    data = ""
+                    break
+
+                if not _is_transient(e):
+                    raise
+
+                attempt += 1
+
+                if attempt > _max_retries:
+                    self._abandon()
+                    raise
+
+                if self._stats:
+                    self._stats.add("retries")
+
+                self._resumed = True
+                time.sleep(_retry_backoff*2**(attempt - 1))
+
+        self._offset += len(data)
+        self._eof = not data or size <= 0
+
+        if self._resumed and self._stats:
+            self._stats.add("retried_bytes", len(data))
+
+        return data
+
+    def close(self):
+        self._close()
+
+    def _next_range(self):
+        self._range_end = self._offset + self._range_size
+        self._range_size *= 2
+        self._opened = False
+
+        if self._key.size is not None:
+            self._range_end = min(self._range_end, self._key.size)
+            self._eof = self._offset >= self._key.size
+
+    def _open(self):
+        self._opened = True
+
+        if self._range_end is not None:
+            self._key.open_read(headers={'Range': "bytes={}-{}".format(self._offset, self._range_end - 1)})
+        elif self._offset:
+            self._key.open_read(headers={'Range': "bytes={}-".format(self._offset)})
+        else:
+            self._key.open_read()
+
+    def _close(self):
+        try:
+            if self._key.resp:  # Connections are kept around otherwise
+                self._key.resp.close()
+
+            self._key.close(True)
+        except TRANSIENT_ERRORS:
+            pass
+
+    def _abandon(self):
+        self._close()
+
+        if self._stats:
+            self._stats.add("abandoned_reads")
+
+            # Bounded reads only give up on the rest of the range being read
+            end = self._key.size
+            if self._range_end is not None:
+                end = self._range_end if end is None else min(end, self._range_end)
+
+            if end is not None:
+                self._stats.add("abandoned_bytes", max(end - self._offset, 0))
+
+
+def _retry(fn, stats):
+    attempt = 0
+
+    while True:
+        try:
+            return fn()
+        except TRANSIENT_ERRORS + (BotoServerError, ) as e:
+            if not _is_transient(e):
+                raise
+
+            attempt += 1
+
+            if attempt > _max_retries:
+                if stats:
+                    stats.add("abandoned_reads")
+                raise
+
+            if stats:
+                stats.add("retries")
+
+            time.sleep(_retry_backoff*2**(attempt - 1))
+
+
+def _is_transient(error):
+    # Server errors are worth retrying, client errors (e.g. 404) aren't
+    return not isinstance(error, BotoServerError) or error.status >= 500
+
+
+if __name__ == "__main__":
+    import re
+
+    class FlakyKey:
+        """ A key whose reads fail every few calls, recording the ranges it's opened with. """
+
+        def __init__(self, data, fail_every=0):
+            self.data = data
+            self.size = len(data)
+            self.resp = None
+            self.ranges = []
+            self._fail_every = fail_every
+            self._reads = 0
+
+        def open_read(self, headers={}):
+            match = re.match(r"bytes=(\d+)-(\d*)$", headers.get("Range", "bytes=0-"))
+            self._position = int(match.group(1))
+            self._end = min(int(match.group(2)) + 1 if match.group(2) else self.size, self.size)
+            self.ranges.append((self._position, self._end))
+
+        def read(self, size=0):
+            self._reads += 1
+            if self._fail_every and self._reads % self._fail_every == 0:
+                raise socket.timeout("timed out")
+
+            end = self._end if size == 0 else min(self._position + size, self._end)
+            data = self.data[self._position:end]
+            self._position = end
+            return data
+
+        def close(self, fast=False):
+            pass
+
+    def read_all(reader, size=700):
+        return "".join(iter(lambda: reader.read(size), ""))
+
+    delays = []
+    time.sleep = delays.append
+    data = "".join(chr(i % 251) for i in range(10000))
+
+    # Interrupted reads are resumed from the last byte consumed
+    stats = ReadStats()
+    key = FlakyKey(data, fail_every=3)
+    assert(read_all(open_key(key, 100, stats)) == data[100:])
+    assert(all(end == key.size for start, end in key.ranges))
+    assert(stats.value()["retries"] == len(key.ranges) - 1 == len(delays))
+    assert(stats.value()["retried_bytes"] > 0 and stats.value()["abandoned_reads"] == 0)
+
+    # Bounded reads are continued with ranges that double in size
+    _continuation_size = 1024
+    key = FlakyKey(data)
+    assert(read_all(open_key(key, 1000, None, 3000)) == data[1000:])
+    assert(key.ranges == [(1000, 3000), (3000, 4024), (4024, 6072), (6072, 10000)])
+
+    # Reads are abandoned after a bounded number of retries, with an exponential backoff
+    del delays[:]
+    stats = ReadStats()
+    reader = open_key(FlakyKey(data, fail_every=1), 1000, stats, 3000)
+
+    try:
+        reader.read(100)
+        assert(False)
+    except socket.timeout:
+        pass
+
+    assert(delays == [_retry_backoff*2**i for i in range(_max_retries)])
+    assert(stats.value()["abandoned_reads"] == 1 and stats.value()["abandoned_bytes"] == 2000)
@@ -10,27 +10,83 @@
 Example usage:
 pings = get_pings(None, app="Firefox", channel="nightly", build_id=("20140401000000", "20140402999999"), reason="saved_session")
 histories = get_clients_history(sc, fraction = 0.01)
+print plan_pings(schema="v4", app="Firefox", submission_date=("20150601", "20150610"))["bytes"]
+
+Passing None instead of a SparkContext runs the queries in a pool of local
+processes, see local.LocalContext.
+
+S3 connections are established lazily, once per process. The endpoint can be
+overridden with the MOZTELEMETRY_S3_ENDPOINT environment variable, e.g.
+"http://localhost:4567", to run against a local S3 stand-in.
+
+Setting MOZTELEMETRY_CACHE_DIR on the executors enables an on-disk cache of the
+S3 objects read, limited to MOZTELEMETRY_CACHE_SIZE bytes (10 GB by default).
 
 """
 
 import boto
+import hashlib
 import liblzma as lzma
 import json as json
+import numbers
+import numpy as np
 import numpy.random as random
-import ssl
+import os
+import pandas as pd
+import posixpath
+import sys
+import threading
+import Queue
 
 from filter_service import SDB
-from histogram import Histogram
-from heka_message_parser import parse_heka_message
+from histogram import Histogram, _add_values, _from_values, _get_definition, _get_values, get_percentiles
+from object_cache import ObjectCache
+from s3_reader import ReadStats, TRANSIENT_ERRORS, get_key, open_key
+from heka_message_parser import RecordFilter, parse_heka_message
+from local import LocalContext
+from metrics import MeteredStream, PipelineMetrics
+from boto.s3.connection import OrdinaryCallingFormat
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
 from xml.sax import SAXParseException
 
-boto.config.add_section('Boto')
-boto.config.set('Boto', 'http_socket_timeout', '10')  # https://github.com/boto/boto/issues/2830
+_bucket_v2_name = "telemetry-published-v2"
+_bucket_v4_name = "net-mozaws-prod-us-west-2-pipeline-data"
+_socket_timeout = 10  # https://github.com/boto/boto/issues/2830
+_block_size = 2**20
+_prefetch_depth = 4
+_history_concurrency = 16
+_max_broadcast_winners = 10**7  # Clients above which get_one_ping_per_client(strategy="keys") shuffles
+_chunk_size = 2**24  # Upper bound, the actual chunk size depends on the parallelism
+_min_chunk_size = 2**20
+_chunk_overlap = 2**18
+_default_revision = "https://hg.mozilla.org/mozilla-central/rev/tip"
+
+_default_cache_size = 10*2**30
+
+# Per-process S3 state, see _get_bucket and _get_cache
+_conn = None
+_conn_pid = None
+_buckets = {}
+_cache = None
+_conn_lock = threading.Lock()
+
+
+def set_s3_endpoint(endpoint=None):
+    """ Points the S3 connection to a different endpoint, e.g. "http://localhost:4567".
+
+        The setting is stored in the environment so that worker processes spawned
+        afterwards inherit it. Passing None restores the default AWS endpoint.
+    """
+    global _conn
+
+    if endpoint:
+        os.environ["MOZTELEMETRY_S3_ENDPOINT"] = endpoint
+    else:
+        os.environ.pop("MOZTELEMETRY_S3_ENDPOINT", None)
 
-_conn = boto.connect_s3()
-_bucket_v2 = _conn.get_bucket("telemetry-published-v2", validate=False)
-_bucket_v4 = _conn.get_bucket("net-mozaws-prod-us-west-2-pipeline-data", validate=False)
-_chunk_size = 2**24
+    _conn = None
 
 
 def get_clients_history(sc, **kwargs):
@@ -47,17 +103,26 @@ def get_clients_history(sc, **kwargs):
     if kwargs:
         raise TypeError("Unexpected **kwargs {}".format(repr(kwargs)))
 
-    clients = [x.name for x in list(_bucket_v4.list(prefix="telemetry_sample_42/", delimiter="/"))]
+    if sc is None:
+        sc = LocalContext()
 
+    clients = _list_client_prefixes(_get_bucket_v4(), "telemetry_sample_42/")
+
+    # All clients of the prefix share sample id 42, so they are selected by a hash of
+    # their id instead, which keeps samples reproducible
     if clients and fraction != 1.0:
-        sample = random.choice(clients, size=len(clients)*fraction, replace=False)
+        sample = [x for x in clients if _get_client_hash(x.split("/")[1]) < fraction]
     else:
         sample = clients
 
-    parallelism = max(len(sample), sc.defaultParallelism)
-    return sc.parallelize(sample, parallelism).\
-        map(lambda x: _read_client_history(x)).\
-        filter(lambda x: x is not None)
+    # Each partition fetches several clients concurrently
+    stats = ReadStats(sc)
+    parallelism = max(min(len(sample), 4*sc.defaultParallelism), 1)
+    histories = sc.parallelize(sample, parallelism).\
+        mapPartitions(lambda x: _read_client_histories(x, stats))
+
+    histories.read_stats = stats
+    return histories
 
 
 def get_pings(sc, **kwargs):
@@ -76,6 +141,7 @@ def get_pings(sc, **kwargs):
     :param submission_date: a submission date or a range of submission dates, e.g:
                             "20150601" or ("20150601", "20150610")
     :param fraction: the fraction of pings to return, set to 1.0 by default
+    :param sample_by: "file" to sample a fraction of the files, which is the default
     :param reason: submission reason, set to "saved_session" by default, e.g: "saved_session"
 
     If schema == "v4" then:
@@ -90,92 +156,462 @@ def get_pings(sc, **kwargs):
     :param source_version: source version, set to "4" by default
     :param doc_type: ping type, set to "main" by default
     :param fraction: the fraction of pings to return, set to 1.0 by default
+    :param sample_by: "file" to sample a random fraction of the files, which is the default,
+                      or "client" to return all pings of a deterministic fraction of the
+                      clients, based on their sample id. In that case the fraction must be
+                      a multiple of 0.01 and records outside of the sample aren't decoded.
+    :param projection: the paths needed from each ping, as accepted by get_pings_properties,
+                       e.g.: ["clientId", "payload/histograms/GC_MS"]. Only those parts of the
+                       pings are decoded and returned, along with the meta fields; the payload
+                       isn't decoded at all if the paths can be served from the message fields.
+    :param record_filter: conditions on the message fields of the records, which are evaluated
+                          before the payload is decoded, e.g.:
+                          {"normalizedChannel": "nightly", "appBuildId": ("20150601000000", None)};
+                          see heka_message_parser.RecordFilter for the accepted conditions.
+
+    If sc is None, the pings are read by a pool of local processes instead of Spark.
+
+    Reads interrupted by transient errors are resumed. The returned RDD has a
+    read_stats attribute with the number of retried and abandoned reads and bytes,
+    and of the records rejected by the record_filter, which is populated once an
+    action has run, e.g.: pings.read_stats.value()
+
+    If metrics is True, the bytes, records, errors and wall and CPU times of each
+    stage of the pipeline are measured, including the extraction of properties by
+    get_pings_properties, and summarized by pings.metrics.summary() once an action
+    has run; see metrics.PipelineMetrics.
     """
     schema = kwargs.pop("schema", "v2")
+
+    if sc is None:
+        sc = LocalContext()
+
+    stats = ReadStats(sc)
+    metrics = PipelineMetrics(sc) if kwargs.pop("metrics", False) else None
+
     if schema == "v2":
-        return _get_pings_v2(sc, **kwargs)
+        pings = _get_pings_v2(sc, stats, metrics, **kwargs)
     elif schema == "v4":
-        return _get_pings_v4(sc, **kwargs)
+        pings = _get_pings_v4(sc, stats, metrics, **kwargs)
     else:
         raise ValueError("Invalid schema version")
 
+    pings.read_stats = stats
+    pings.metrics = metrics
+    return pings
 
-def get_pings_properties(pings, paths, only_median=False):
+
+def plan_pings(sc=None, **kwargs):
+    """
+    Returns the cost of get_pings(sc, **kwargs) without reading any data, e.g.:
+    {"schema": "v4", "matched_files": 2400, "files": 240, "bytes": 32212254720,
+     "chunks": 1930, "chunk_size": 16777216, "partitions": 1930,
+     "days": {"20150601": {"files": 120, "bytes": 16106127360}, ...}}
+
+    The files are resolved through the index and their sizes are listed, as
+    get_pings does. When a fraction of the files is sampled, the plan is that
+    of one random sample of the same size as the one get_pings draws. The
+    partitions are suggested for the parallelism of sc, or of the local
+    machine if sc is None.
+    """
+    schema = kwargs.pop("schema", "v2")
+    fraction = kwargs.pop("fraction", 1.0)
+    sample_by = kwargs.pop("sample_by", "file")
+
+    # These don't change which files are read
+    for name in ("projection", "record_filter", "metrics"):
+        kwargs.pop(name, None)
+
+    if fraction < 0 or fraction > 1:
+        raise ValueError("Invalid fraction argument")
+
+    if sc is None:
+        sc = LocalContext()
+
+    if schema == "v2":
+        if sample_by != "file":
+            raise ValueError("Invalid sample_by argument, v2 pings can only be sampled by file")
+
+        kwargs.setdefault("reason", "saved_session")
+        files = _get_filenames_v2(**kwargs)
+        bucket = _get_bucket_v2()
+        get_date = lambda filename: posixpath.basename(filename).split(".")[1]
+    elif schema == "v4":
+        if sample_by not in ("file", "client"):
+            raise ValueError("Invalid sample_by argument")
+
+        kwargs.setdefault("source_name", "telemetry")
+        kwargs.setdefault("source_version", "4")
+        kwargs.setdefault("doc_type", "main")
+        files = _get_filenames_v4(**kwargs)
+        bucket = _get_bucket_v4()
+        get_date = lambda filename: filename.split("/")[1]
+    else:
+        raise ValueError("Invalid schema version")
+
+    # Client samples are evaluated per record, so all files are read
+    if files and fraction != 1.0 and sample_by == "file":
+        sample = random.choice(files, size=int(len(files)*fraction), replace=False)
+    else:
+        sample = files
+
+    sizes = [size for size, etag in _get_object_entries(bucket, sample)] if len(sample) else []
+    days = {}
+
+    for filename, size in zip(sample, sizes):
+        day = days.setdefault(get_date(filename), {"files": 0, "bytes": 0})
+        day["files"] += 1
+        day["bytes"] += size
+
+    plan = {"schema": schema, "matched_files": len(files), "files": len(sample), "bytes": sum(sizes), "days": days}
+
+    if schema == "v2":
+        # Each file is read and decompressed as a whole by a single task
+        plan.update({"chunks": len(sample), "chunk_size": None,
+                     "partitions": max(len(sample), sc.defaultParallelism)})
+    elif len(sample):
+        chunk_size = _get_chunk_size(sum(sizes), sc.defaultParallelism)
+        n_chunks = sum(size/chunk_size + 1 for size in sizes)
+        plan.update({"chunks": n_chunks, "chunk_size": chunk_size, "partitions": n_chunks})
+    else:
+        plan.update({"chunks": 0, "chunk_size": None, "partitions": 0})
+
+    return plan
+
+
+def get_pings_properties(pings, paths, only_median=False, batch_size=None):
     """
     Returns a RDD of a subset of properties of pings. Child histograms are
     automatically merged with the parent histogram.
-    """
-    if type(pings.first()) == str:
-        pings = pings.map(lambda p: json.loads(p))
 
-    if type(paths) == str:
+    If batch_size is set, each partition yields PropertyBatch objects of up to
+    batch_size pings instead of a dictionary per ping.
+    """
+    if isinstance(paths, basestring):
         paths = [paths]
 
-    # Use '/' as dots can appear in keyed histograms
-    paths = [(path, path.split("/")) for path in paths]
-    return pings.map(lambda p: _get_ping_properties(p, paths, only_median)).filter(lambda p: p)
+    if batch_size is not None and batch_size < 1:
+        raise ValueError("Invalid batch_size argument")
+
+    # The paths are compiled once on the driver and shipped with the closure
+    extractor = _PropertyExtractor(paths, only_median)
+    metrics = getattr(pings, "metrics", None)
+
+    if batch_size:
+        return pings.mapPartitions(lambda x: extractor.extract_batches(x, batch_size, metrics))
+    else:
+        return pings.mapPartitions(lambda x: extractor.extract_partition(x, metrics))
 
 
-def get_one_ping_per_client(pings):
+def aggregate_histograms(pings, names, by=None, revision=_default_revision):
     """
-    Returns a single ping for each client in the RDD. This operation is expensive
-    as it requires data to be shuffled around. It should be run only after extracting
-    a subset with get_pings_properties.
+    Returns the sum of histograms across all pings, as a dictionary of Histogram objects
+    named like the ones returned by get_pings_properties (merged, "_parent" and "_children").
+
+    :param names: a histogram path or a list of histogram paths, e.g.: "payload/histograms/GC_MS"
+    :param by: an optional property path or list of property paths to group by, e.g.:
+               "meta/appUpdateChannel". If set, a dictionary of results is returned
+               for each tuple of property values.
     """
-    if type(pings.first()) == str:
-        pings = pings.map(lambda p: json.loads(p))
+    if isinstance(names, basestring):
+        names = [names]
+
+    if isinstance(by, basestring):
+        by = [by]
+
+    aggregator = _HistogramAggregator(names, by, revision)
+    aggregates = pings.treeAggregate({}, aggregator.add, aggregator.merge)
+    result = {group: aggregator.to_histograms(values) for group, values in aggregates.iteritems()}
+
+    if by is None:
+        return result.get((), {})
+
+    return result
+
+
+def get_one_ping_per_client(pings, strategy="shuffle", selection="first"):
+    """
+    Returns a single ping for each client in the RDD. Pings without a clientID/clientId
+    attribute are dropped.
+
+    :param strategy: how the pings are deduplicated:
+                     - "shuffle" (default) shuffles the pings around. This is expensive and
+                       should be run only after extracting a subset with get_pings_properties.
+                     - "keys" shuffles only the client ids and ping ordinals to pick a ping
+                       per client, then selects the winning pings in a second pass over the
+                       input, which should be cached unless it's cheap to recompute. The
+                       winning ordinals are broadcast to every task, about 4 bytes per
+                       client, so above 10 million clients "shuffle" is used instead.
+                     - "partitioned" doesn't shuffle at all and assumes that all pings of a
+                       client are in the same partition.
+    :param selection: which ping to keep for a client: "first", "latest" by meta Timestamp,
+                      or a function of a ping that returns a sort key, the ping with the
+                      largest key being kept. Ties are resolved in favor of the first ping.
+    """
+    rank = _get_ping_rank(selection)
+    pings = pings.map(lambda p: json.loads(p) if isinstance(p, basestring) else p)
+
+    if strategy == "shuffle":
+        return pings.mapPartitionsWithIndex(lambda i, x: _rank_pings(i, x, rank)).\
+            reduceByKey(max).\
+            map(lambda p: p[1][1])
+    elif strategy == "keys":
+        winners = pings.mapPartitionsWithIndex(lambda i, x: _rank_pings(i, x, rank, keep_ping=False)).\
+            reduceByKey(max).\
+            cache()
+
+        # The winners of too many clients would strain the driver and every executor
+        if winners.count() > _max_broadcast_winners:
+            winners.unpersist()
+            return get_one_ping_per_client(pings, "shuffle", selection)
+
+        # The winning ordinals are grouped by input partition on the cluster, so that
+        # the driver only holds compact arrays and each task only reads its own.
+        grouped = winners.\
+            mapPartitions(_group_winners).\
+            reduceByKey(lambda x, y: np.concatenate((x, y))).\
+            collect()
+        winners.unpersist()
+
+        grouped = pings.context.broadcast(dict(grouped))
+        return pings.mapPartitionsWithIndex(lambda i, x: _select_pings(i, x, grouped))
+    elif strategy == "partitioned":
+        return pings.mapPartitions(lambda x: _select_partition_pings(x, rank))
+    else:
+        raise ValueError("Invalid strategy argument")
+
+
+def _get_client_id(ping):
+    if "clientID" in ping:
+        return ping["clientID"]  # v2
+
+    return ping.get("clientId", None)  # v4
+
+
+def _get_ping_timestamp(ping):
+    # Pings returned by get_pings_properties have a flat "meta/Timestamp" attribute
+    if "meta/Timestamp" in ping:
+        return ping["meta/Timestamp"]
+
+    return ping.get("meta", {}).get("Timestamp", None)
+
 
-    filtered = pings.filter(lambda p: "clientID" in p or "clientId" in p)
+def _get_ping_rank(selection):
+    if selection == "first":
+        return lambda p: 0
+    elif selection == "latest":
+        return _get_ping_timestamp
+    elif callable(selection):
+        return selection
+    else:
+        raise ValueError("Invalid selection argument")
+
+
+def _rank_pings(partition, pings, rank, keep_ping=True):
+    for i, ping in enumerate(pings):
+        client_id = _get_client_id(ping)
+
+        if client_id is not None:
+            # The ping with the highest rank wins, ties are resolved by the lowest (partition, index)
+            key = (rank(ping), -partition, -i)
+            yield (client_id, (key, ping) if keep_ping else (key, ))
+
+
+def _group_winners(winners):
+    """ Yields the ordinals of the winning pings of each input partition as an int32 array. """
+    groups = {}
+
+    for client_id, (key, ) in winners:
+        groups.setdefault(-key[1], []).append(-key[2])
+
+    for partition, indices in groups.iteritems():
+        yield partition, np.array(indices, dtype="int32")
+
+
+def _select_pings(partition, pings, winners):
+    winners = set(winners.value.get(partition, np.array([], dtype="int32")).tolist())
+
+    for i, ping in enumerate(pings):
+        if i in winners:
+            yield ping
+
+
+def _select_partition_pings(pings, rank):
+    selected = {}
+
+    for client_id, (key, ping) in _rank_pings(0, pings, rank):
+        current = selected.get(client_id, None)
+
+        if current is None or key > current[0]:
+            selected[client_id] = (key, ping)
+
+    return (ping for key, ping in selected.itervalues())
 
-    if not filtered:
-        raise ValueError("Missing clientID/clientId attribute.")
 
-    if "clientID" in filtered.first():
-        client_id = "clientID"  # v2
+def _get_process_connection():
+    global _conn, _conn_pid
+
+    # Executors fork their Python workers, so a connection inherited from the
+    # parent process can't be reused: its sockets are shared with the parent.
+    pid = os.getpid()
+    if _conn is not None and _conn_pid == pid:
+        return _conn
+
+    endpoint = os.environ.get("MOZTELEMETRY_S3_ENDPOINT")
+    if endpoint:
+        url = urlparse(endpoint)
+        conn = boto.connect_s3(host=url.hostname, port=url.port, is_secure=(url.scheme == "https"),
+                               calling_format=OrdinaryCallingFormat())
     else:
-        client_id = "clientId"  # v4
+        conn = boto.connect_s3()
+
+    # Set the timeout on the connection rather than in the global boto config
+    conn.http_connection_kwargs["timeout"] = _socket_timeout
+
+    _conn, _conn_pid = conn, pid
+    _buckets.clear()
+    return _conn
+
+
+def _get_bucket(name):
+    with _conn_lock:
+        conn = _get_process_connection()
+        bucket = _buckets.get(name, None)
+
+        if bucket is None:
+            bucket = _buckets[name] = conn.get_bucket(name, validate=False)
+
+        return bucket
+
+
+def _get_cache():
+    global _cache
+
+    path = os.environ.get("MOZTELEMETRY_CACHE_DIR")
+    if not path:
+        return None
+
+    if _cache is None or _cache.path != path:
+        _cache = ObjectCache(path, int(os.environ.get("MOZTELEMETRY_CACHE_SIZE", _default_cache_size)))
+
+    return _cache
+
+
+def _open_object(key, start=0, length_hint=None, stats=None, end=None):
+    """ Returns a file-like object to read a key from the given offset, through the cache if enabled. """
+    cache = _get_cache()
+    if cache:
+        return cache.open(key, start, length_hint, stats, end)
 
-    return filtered.map(lambda p: (p[client_id], p)).\
-                    reduceByKey(lambda p1, p2: p1).\
-                    map(lambda p: p[1])
+    return open_key(key, start, stats, end)
 
 
-def _read_client_history(client_prefix):
+def _get_bucket_v2():
+    return _get_bucket(_bucket_v2_name)
+
+
+def _get_bucket_v4():
+    return _get_bucket(_bucket_v4_name)
+
+
+def _get_client_hash(client_id):
+    """ Maps a client id to a number in [0, 1) in a reproducible way. """
+    return int(hashlib.md5(client_id).hexdigest()[:8], 16)/float(2**32)
+
+
+def _list_client_prefixes(bucket, prefix):
+    """
+    Lists the client prefixes under a prefix. The key space is split in shards, delimited
+    by the hexadecimal digits client ids start with, which are listed concurrently.
+    """
+    boundaries = [None] + [prefix + c for c in "123456789abcdef"] + [None]
+
+    def list_shard(i):
+        start, end = boundaries[i], boundaries[i + 1]
+        result = []
+
+        for x in bucket.list(prefix=prefix, delimiter="/", marker=start or ""):
+            if end is not None and x.name >= end:
+                break
+            result.append(x.name)
+
+        return result
+
+    pool = ThreadPool(len(boundaries) - 1)
     try:
-        paths = [x.name for x in list(_bucket_v4.list(prefix=client_prefix))]
-        return [ping for x in paths for ping in _read_v4(x)]
+        return [name for shard in pool.map(list_shard, range(len(boundaries) - 1)) for name in shard]
+    finally:
+        pool.close()
+
+
+def _read_client_histories(client_prefixes, stats=None):
+    """ Reads the histories of clients, up to _history_concurrency at a time, preserving their order. """
+    pool = ThreadPool(_history_concurrency)
+    pending = deque()
+
+    try:
+        for client_prefix in client_prefixes:
+            pending.append(pool.apply_async(_read_client_history, (client_prefix, stats)))
+
+            if len(pending) >= 2*_history_concurrency:
+                history = pending.popleft().get()
+                if history is not None:
+                    yield history
+
+        while pending:
+            history = pending.popleft().get()
+            if history is not None:
+                yield history
+    finally:
+        pool.terminate()
+
+
+def _read_client_history(client_prefix, stats=None):
+    try:
+        keys = list(_get_bucket_v4().list(prefix=client_prefix))
+        return [ping for key in keys for ping in _read_v4(key, stats)]
     except SAXParseException:  # https://groups.google.com/forum/#!topic/boto-users/XCtTFzvtKRs
         return None
 
 
-def _get_pings_v2(sc, **kwargs):
+def _get_pings_v2(sc, stats, metrics=None, **kwargs):
     app = kwargs.pop("app", None)
     channel = kwargs.pop("channel", None)
     version = kwargs.pop("version", None)
     build_id = kwargs.pop("build_id", None)
     submission_date = kwargs.pop("submission_date", None)
     fraction = kwargs.pop("fraction", 1.0)
+    sample_by = kwargs.pop("sample_by", "file")
     reason = kwargs.pop("reason", "saved_session")
 
     if fraction < 0 or fraction > 1:
         raise ValueError("Invalid fraction argument")
 
+    if sample_by != "file":
+        raise ValueError("Invalid sample_by argument, v2 pings can only be sampled by file")
+
     if kwargs:
         raise TypeError("Unexpected **kwargs {}".format(repr(kwargs)))
 
+    if metrics:
+        metrics.start("index")
+
     files = _get_filenames_v2(app=app, channel=channel, version=version, build_id=build_id,
                               submission_date=submission_date, reason=reason)
 
+    if metrics:
+        metrics.stop(records=len(files))
+
     if files and fraction != 1.0:
-        sample = random.choice(files, size=len(files)*fraction, replace=False)
+        sample = random.choice(files, size=int(len(files)*fraction), replace=False)
     else:
         sample = files
 
     parallelism = max(len(sample), sc.defaultParallelism)
-    return sc.parallelize(sample, parallelism).flatMap(lambda x: _read_v2(x))
+    return sc.parallelize(sample, parallelism).flatMap(lambda x: _read_v2(x, stats, metrics))
 
 
-def _get_pings_v4(sc, **kwargs):
+def _get_pings_v4(sc, stats, metrics=None, **kwargs):
     app = kwargs.pop("app", None)
     channel = kwargs.pop("channel", None)
     version = kwargs.pop("version", None)
@@ -185,28 +621,127 @@ def _get_pings_v4(sc, **kwargs):
     source_version = kwargs.pop("source_version", "4")
     doc_type = kwargs.pop("doc_type", "main")
     fraction = kwargs.pop("fraction", 1.0)
+    sample_by = kwargs.pop("sample_by", "file")
+    projection = kwargs.pop("projection", None)
+    record_filter = kwargs.pop("record_filter", None)
 
     if fraction < 0 or fraction > 1:
         raise ValueError("Invalid fraction argument")
 
+    if projection is not None:
+        projection = _PropertyExtractor(projection).projection()
+
+    if record_filter is not None:
+        record_filter = RecordFilter(record_filter)
+
+    if sample_by not in ("file", "client"):
+        raise ValueError("Invalid sample_by argument")
+
     if kwargs:
         raise TypeError("Unexpected **kwargs {}".format(repr(kwargs)))
 
+    sample_ids = None
+    if sample_by == "client" and fraction != 1.0:
+        sample_ids = _get_sample_ids(fraction)
+
+    if metrics:
+        metrics.start("index")
+
     files = _get_filenames_v4(app=app, channel=channel, version=version, build_id=build_id, submission_date=submission_date,
                               source_name=source_name, source_version=source_version, doc_type=doc_type)
 
-    if files and fraction != 1.0:
-        sample = random.choice(files, size=len(files)*fraction, replace=False)
+    if metrics:
+        metrics.stop(records=len(files))
+
+    # The index doesn't have a sample id dimension, so client samples can't
+    # prune files and are evaluated per record instead.
+    if files and fraction != 1.0 and sample_by == "file":
+        sample = random.choice(files, size=int(len(files)*fraction), replace=False)
     else:
         sample = files
 
-    parallelism = max(len(sample), sc.defaultParallelism)
-    ranges = sc.parallelize(sample, parallelism).flatMap(_read_v4_ranges).collect()
-
-    if len(ranges) == 0:
+    if len(sample) == 0:
         return sc.parallelize([])
-    else:
-        return sc.parallelize(ranges, len(ranges)).flatMap(_read_v4_range)
+
+    # Only the cumulative number of chunks per file is kept on the driver; the
+    # chunks are expanded from their global index within the read stage.
+    if metrics:
+        metrics.start("listing")
+
+    # The sizes and etags are kept as well, so that tasks don't request them again
+    entries = _get_object_entries(_get_bucket_v4(), sample)
+    sizes = [size for size, etag in entries]
+
+    if metrics:
+        metrics.stop(bytes=sum(sizes), records=len(sizes))
+
+    chunk_size = _get_chunk_size(sum(sizes), sc.defaultParallelism)
+    offsets = np.cumsum([size/chunk_size + 1 for size in sizes])
+    plan = sc.broadcast((list(sample), offsets, chunk_size, entries))
+
+    n_chunks = int(offsets[-1])
+    return sc.parallelize(xrange(n_chunks), n_chunks).\
+        flatMap(lambda i: _read_v4_range(_get_v4_range(plan.value, i), plan.value[2], sample_ids, projection, record_filter,
+                                         stats, metrics))
+
+
+def _get_object_entries(bucket, filenames):
+    """
+    Returns the sizes and etags of the given objects. These are read from the listings
+    of their parent "directories", which return up to a thousand objects per request,
+    and only objects missing from the listings are fetched individually.
+    """
+    prefixes = set(posixpath.dirname(filename) + "/" for filename in filenames)
+    pool = ThreadPool(min(len(prefixes), 32))
+
+    def list_prefix(prefix):
+        return [(key.name, (key.size, key.etag)) for key in bucket.list(prefix=prefix, delimiter="/")
+                if hasattr(key, "size")]
+
+    def get_entry(filename):
+        key = get_key(bucket, filename)
+        return filename, (key.size, key.etag)
+
+    try:
+        entries = dict(entry for entries in pool.map(list_prefix, prefixes) for entry in entries)
+        missing = [filename for filename in filenames if filename not in entries]
+        entries.update(pool.map(get_entry, missing))
+    finally:
+        pool.close()
+
+    return [entries[filename] for filename in filenames]
+
+
+def _new_key(bucket, filename, size, etag):
+    """ Returns the key of a listed object without requesting its metadata again. """
+    key = bucket.new_key(filename)
+    key.size = size
+    key.etag = etag
+    return key
+
+
+def _get_sample_ids(fraction):
+    """ Returns the sample ids of a fraction of the clients, as computed by the data pipeline. """
+    n_sample_ids = int(round(fraction*100))
+
+    if abs(n_sample_ids - fraction*100) > 1e-6:
+        raise ValueError("Invalid fraction argument, client samples must be a multiple of 0.01")
+
+    return frozenset(range(n_sample_ids))
+
+
+def _get_chunk_size(total_bytes, parallelism):
+    # Aim for a few chunks per core so that stragglers can be balanced
+    chunk_size = total_bytes/(4*max(parallelism, 1))
+    return int(min(max(chunk_size, _min_chunk_size), _chunk_size))
+
+
+def _get_v4_range(plan, index):
+    filenames, offsets, chunk_size, entries = plan
+    file_index = np.searchsorted(offsets, index, side="right")
+    first_chunk = offsets[file_index - 1] if file_index else 0
+    size, etag = entries[file_index]
+    return filenames[file_index], int(index - first_chunk), size, etag
 
 
 def _get_filenames_v2(**kwargs):
@@ -247,126 +782,676 @@ def _get_filenames_v4(**kwargs):
     return sdb.query(**query)
 
 
-def _read_v2(filename):
+def _read_v2(filename, stats=None, metrics=None):
     try:
-        key = _bucket_v2.get_key(filename)
-        compressed = key.get_contents_as_string()
-        raw = lzma.decompress(compressed).split("\n")[:-1]
-        return map(lambda x: x.split("\t", 1)[1], raw)
-    except ssl.SSLError:
-        return []
-
+        key = get_key(_get_bucket_v2(), filename, stats)
+        stream = _open_object(key, stats=stats)
+
+        if metrics:
+            stream = MeteredStream(stream, metrics)
+
+        # Download the next blocks while the current one is being decompressed
+        blocks = _prefetch(iter(lambda: stream.read(_block_size), ""), _prefetch_depth)
+
+        try:
+            for line in _iter_lzma_lines(blocks, metrics):
+                yield line.split("\t", 1)[1]
+        finally:
+            # Closing the blocks joins the prefetching thread, which may be reading the stream
+            blocks.close()
+            stream.close()
+    except TRANSIENT_ERRORS:
+        pass
+
+
+def _iter_lzma_lines(blocks, metrics=None):
+    """ Decompresses a stream of LZMA blocks and yields its newline-terminated lines. """
+    decompressor = lzma.LZMADecompressor()
+    pending = ""
+
+    for block in blocks:
+        while True:
+            if metrics:
+                metrics.start("decompression")
+
+            # Bound the size of the output of highly compressed blocks
+            data = decompressor.decompress(block, _block_size)
+            block = decompressor.unconsumed_tail
+            lines = (pending + data).split("\n")
+            pending = lines.pop()
+
+            if metrics:
+                metrics.stop(bytes=len(data), records=len(lines))
+
+            for line in lines:
+                yield line
+
+            if not block and len(data) < _block_size:
+                break
+
+    # A trailing line without newline is dropped, as it has always been
+    lines = (pending + decompressor.flush()).split("\n")
+    for line in lines[:-1]:
+        yield line
+
+
+def _prefetch(iterable, depth):
+    """ Consumes an iterable from a background thread, keeping up to depth items ahead. """
+    queue = Queue.Queue(depth)
+    done = threading.Event()
+
+    def put(item):
+        while not done.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((None, None))
+        except:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
 
-def _read_v4(filename):
     try:
-        key = _bucket_v4.get_key(filename)
-        key.open_read()
-        return parse_heka_message(key)
-    except ssl.SSLError:
-        return []
+        while True:
+            item, error = queue.get()
+
+            if error:
+                raise error[0], error[1], error[2]
+            elif item is None:
+                return
 
+            yield item
+    finally:
+        done.set()
+        thread.join()
 
-def _read_v4_ranges(filename):
+
+def _read_v4(key, stats=None):
+    """ Reads a key as returned by a listing, which holds its size and etag already. """
     try:
-        key = _bucket_v4.get_key(filename)
-        n_chunks = (key.size / _chunk_size) + 1
-        return zip([filename]*n_chunks, range(n_chunks))
-    except ssl.SSLError:
+        return parse_heka_message(_open_object(key, stats=stats))
+    except TRANSIENT_ERRORS:
         return []
 
 
-def _read_v4_range(filename_chunk):
+def _read_v4_range(filename_chunk, chunk_size=_chunk_size, sample_ids=None, projection=None, record_filter=None,
+                   stats=None, metrics=None):
     try:
-        filename, chunk = filename_chunk
-        start = _chunk_size*chunk
-        key = _bucket_v4.get_key(filename)
-        key.open_read(headers={'Range': "bytes={}-".format(start)})
-        return parse_heka_message(key, boundary_bytes=_chunk_size)
-    except ssl.SSLError:
+        filename, chunk, size, etag = filename_chunk
+        start = chunk_size*chunk
+        key = _new_key(_get_bucket_v4(), filename, size, etag)
+
+        # A chunk owns the records that start within it, the last one of which
+        # usually ends within the overlap with the next chunk.
+        stream = _open_object(key, start, chunk_size, stats, start + chunk_size + _chunk_overlap)
+
+        if metrics:
+            stream = MeteredStream(stream, metrics)
+
+        return parse_heka_message(stream, boundary_bytes=chunk_size, sample_ids=sample_ids, projection=projection,
+                                  record_filter=record_filter, stats=stats, metrics=metrics)
+    except TRANSIENT_ERRORS:
         return []
 
 
-def _get_ping_properties(ping, paths, only_median):
+def _merge_histograms(histogram_name, name, parent, children):
+    """
+    Returns the parent, children and merged histograms of the raw histograms of
+    a ping, where missing ones are None. The bucket counts are summed in place
+    before any Histogram is built.
+    """
     result = {}
+    children = [child for child in children if child is not None]
 
-    for property_name, path in paths:
-        cursor = ping
+    if parent is None and not children:
+        return result
 
-        if path[0] == "payload":
-            path = path[1:]  # Translate v4 histogram queries to v2 ones
-            cursor = ping["payload"]
+    definition = _get_definition(histogram_name, _default_revision)
+    parent_values = _get_values(definition, name, parent) if parent is not None else None
+    children_values = None
 
-        if path[0] == "histograms" or path[0] == "keyedHistograms":
-            props = _get_merged_histograms(cursor, path)
+    for child in children:
+        values = _get_values(definition, name, child)
+        children_values = values if children_values is None else _add_values(children_values, values)
 
-            for k, v in props.iteritems():
-                result[k] = v.get_value(only_median)
-        else:
-            prop = _get_ping_property(cursor, path)
+    if parent_values is not None:
+        result[name + "_parent"] = result[name] = _from_values(definition, name, parent_values)
 
-            if prop is None:
+    if children_values is not None:
+        result[name + "_children"] = result[name] = _from_values(definition, name, children_values)
+
+    # Merge parent and children
+    if parent_values is not None and children_values is not None:
+        result[name] = _from_values(definition, name, parent_values + children_values)
+
+    return result
+
+
+class _PropertyExtractor:
+    """ Extracts a fixed set of properties from pings.
+
+    The paths are interpreted once, when the extractor is built: scalar paths are
+    merged into a prefix tree so that common prefixes are walked only once per ping,
+    while histogram paths are resolved to the location of the histogram within the
+    (possibly nested) payload.
+    """
+
+    def __init__(self, paths, only_median=False):
+        self.only_median = only_median
+        self._scalars = [[], {}]  # [property names, children]
+        self._histograms = {False: [], True: []}  # Keyed by whether the path is within the payload
+
+        for property_name in paths:
+            # Use '/' as dots can appear in keyed histograms
+            path = property_name.split("/")
+            in_payload = path[0] == "payload"
+
+            if in_payload and len(path) > 1 and path[1] in ("histograms", "keyedHistograms"):
+                path = path[1:]  # Translate v4 histogram queries to v2 ones
+
+            if path[0] == "histograms" and len(path) == 2:
+                self._histograms[in_payload].append((tuple(path), path[1], path[1]))
+            elif path[0] == "keyedHistograms" and len(path) >= 3:
+                # Deal with histogram names that contain a slash...
+                key = "/".join(path[2:])
+                self._histograms[in_payload].append(((path[0], path[1], key), path[1], path[1] + "/" + key))
+            else:
+                node = self._scalars
+                for partial in path:
+                    node = node[1].setdefault(partial, [[], {}])
+                node[0].append(property_name)
+
+        self._histograms = [(payload, specs) for payload, specs in self._histograms.iteritems() if specs]
+
+    def projection(self):
+        """ Returns the paths of the pings that the extraction depends on. """
+        paths = _scalar_paths(self._scalars)
+
+        for in_payload, specs in self._histograms:
+            prefix = ("payload", ) if in_payload else ()
+            paths.append(prefix + ("childPayloads", ))
+            paths.extend(prefix + path[:2] for path, _, _ in specs)
+
+        return paths
+
+    def __call__(self, ping):
+        result = self.extract_scalars(ping)
+        values = {}
+
+        # Building a Series is the bulk of the cost, so aliases of the same histogram,
+        # e.g. a parent histogram without children, share theirs.
+        for k, v in self.extract_histograms(ping).iteritems():
+            if id(v) not in values:
+                values[id(v)] = v.get_value(self.only_median)
+
+            result[k] = values[id(v)]
+
+        return result
+
+    def extract_scalars(self, ping):
+        result = {}
+        _extract_scalars(ping, self._scalars, result)
+        return result
+
+    def extract_histograms(self, ping):
+        """ Returns the Histogram objects of a ping, with child histograms merged. """
+        result = {}
+
+        for in_payload, specs in self._histograms:
+            cursor = ping.get("payload", None) if in_payload else ping
+            if cursor is None:
+                continue
+
+            children = cursor.get("childPayloads", None) or []
+
+            for path, histogram_name, name in specs:
+                parent = _lookup(cursor, path)
+                result.update(_merge_histograms(histogram_name, name, parent, [_lookup(child, path) for child in children]))
+
+        return result
+
+    def extract_partition(self, pings, metrics=None):
+        """
+        Extracts the properties of an iterable of pings, skipping pings without any.
+        The decoding and extraction stages are accounted in the optional metrics.
+        """
+        for ping in pings:
+            if metrics is None:
+                result = self(json.loads(ping) if isinstance(ping, basestring) else ping)
+            else:
+                result = _metered_extraction(self, ping, metrics)
+
+            if result:
+                yield result
+
+    def extract_batches(self, pings, batch_size, metrics=None):
+        """ Like extract_partition but yields PropertyBatch objects of up to batch_size pings. """
+        builder = _PropertyBatchBuilder()
+        extract = lambda ping: (self.extract_scalars(ping), self.extract_histograms(ping))
+
+        for ping in pings:
+            if metrics is None:
+                ping = json.loads(ping) if isinstance(ping, basestring) else ping
+                scalars, histograms = extract(ping)
+            else:
+                scalars, histograms = _metered_extraction(extract, ping, metrics)
+
+            if not scalars and not histograms:
                 continue
 
-            result[property_name] = prop
+            # The bucket counts are copied into the matrices as they are, without a Series
+            for k, v in histograms.iteritems():
+                if v.kind in ("exponential", "linear", "enumerated", "boolean") and not self.only_median:
+                    builder.add_histogram(k, v)
+                else:
+                    scalars[k] = v.get_value(self.only_median)
+
+            builder.add_scalars(scalars)
+            builder.next_row()
+
+            if len(builder) == batch_size:
+                yield builder.build()
+                builder = _PropertyBatchBuilder()
+
+        if len(builder):
+            yield builder.build()
+
+
+def _metered_extraction(extract, ping, metrics):
+    if isinstance(ping, basestring):
+        metrics.start("decoding")
+
+        try:
+            size = len(ping)
+            ping = json.loads(ping)
+        except:
+            metrics.stop(errors=1)
+            raise
+
+        metrics.stop(bytes=size, records=1)
+
+    metrics.start("extraction")
 
+    try:
+        result = extract(ping)
+    except:
+        metrics.stop(errors=1)
+        raise
+
+    metrics.stop(records=1)
     return result
 
 
-def _get_ping_property(cursor, path):
-    is_histogram = False
-    is_keyed_histogram = False
+class PropertyBatch:
+    """ A columnar batch of ping properties, as returned by get_pings_properties with a batch_size.
 
-    if path[0] == "histograms":
-        is_histogram = True
-    elif path[0] == "keyedHistograms":
-        # Deal with histogram names that contain a slash...
-        path = path[:2] + (["/".join(path[2:])] if len(path) > 2 else [])
-        is_keyed_histogram = True
+    Scalar properties are stored as typed NumPy arrays, with missing values represented
+    as NaN (numeric columns) or None. Histograms are stored as 2-D int64 matrices with
+    one row per ping, a boolean mask of the rows that have the histogram and the lower
+    bounds of the buckets.
 
-    for partial in path:
-        cursor = cursor.get(partial, None)
+    Example usage:
+    batches = get_pings_properties(pings, paths, batch_size=1000)
+    frame = PropertyBatch.concat(batches.collect()).to_dataframe()
+    """
 
-        if cursor is None:
-            break
+    def __init__(self, size, scalars, histograms):
+        self.size = size
+        self.scalars = scalars
+        self.histograms = histograms  # name -> (ranges, matrix, present)
+
+    def __len__(self):
+        return self.size
+
+    def histogram_matrix(self, name):
+        """ Returns the matrix of a histogram column as a DataFrame indexed by bucket. """
+        ranges, matrix, present = self.histograms[name]
+        return pd.DataFrame(matrix, columns=ranges)
+
+    def percentiles(self, name, percentiles):
+        """
+        Returns the percentiles of a histogram column for each ping, computed in one
+        pass, with NaN for pings without the histogram; see histogram.get_percentiles.
+        """
+        ranges, matrix, present = self.histograms[name]
+        result = get_percentiles(matrix, ranges, percentiles)
+        result[~present] = np.nan
+        return result
 
-    if cursor is None:
-        return None
-    if is_histogram:
-        return Histogram(path[-1], cursor)
-    elif is_keyed_histogram:
-        histogram = Histogram(path[-2], cursor)
-        histogram.name = "/".join(path[1:])
-        return histogram
+    def to_dataframe(self):
+        """
+        Returns a DataFrame with a column per property. The cells of histogram columns
+        are views on the rows of the matrix, or None for pings without the histogram.
+        """
+        frame = pd.DataFrame(self.scalars, index=range(self.size))
+
+        for name, (ranges, matrix, present) in self.histograms.iteritems():
+            column = np.empty(self.size, dtype=object)
+            for i in np.flatnonzero(present):
+                column[i] = matrix[i]
+            frame[name] = column
+
+        return frame
+
+    @staticmethod
+    def concat(batches):
+        """ Concatenates a list of batches into a single one. """
+        batches = [batch for batch in batches if len(batch)]
+        size = sum(len(batch) for batch in batches)
+        scalars = {}
+        histograms = {}
+
+        for name in set(k for batch in batches for k in batch.scalars):
+            parts = [batch.scalars.get(name, None) for batch in batches]
+            numeric = all(part.dtype.kind in "biuf" for part in parts if part is not None)
+            scalars[name] = np.concatenate([part if part is not None else _missing_column(len(batch), numeric)
+                                            for part, batch in zip(parts, batches)])
+
+        for name in set(k for batch in batches for k in batch.histograms):
+            parts = [batch.histograms.get(name, None) for batch in batches]
+            ranges = next(part[0] for part in parts if part is not None)
+            matrices = []
+            masks = []
+
+            for part, batch in zip(parts, batches):
+                if part is None:
+                    matrices.append(np.zeros((len(batch), len(ranges)), dtype="int64"))
+                    masks.append(np.zeros(len(batch), dtype=bool))
+                elif len(part[0]) != len(ranges):
+                    raise ValueError("Histogram {} has inconsistent buckets across batches".format(name))
+                else:
+                    matrices.append(part[1])
+                    masks.append(part[2])
+
+            histograms[name] = (ranges, np.vstack(matrices), np.concatenate(masks))
+
+        return PropertyBatch(size, scalars, histograms)
+
+
+class _PropertyBatchBuilder:
+    def __init__(self):
+        self._size = 0
+        self._scalars = {}
+        self._histograms = {}
+
+    def __len__(self):
+        return self._size
+
+    def add_scalars(self, scalars):
+        for k, v in scalars.iteritems():
+            column = self._scalars.get(k, None)
+            if column is None:
+                column = self._scalars[k] = [None]*self._size
+            column.append(v)
+
+    def add_histogram(self, name, histogram):
+        column = self._histograms.get(name, None)
+        if column is None:
+            column = self._histograms[name] = (histogram.definition.ranges(), {})
+        column[1][self._size] = histogram.values
+
+    def next_row(self):
+        self._size += 1
+
+        for column in self._scalars.itervalues():
+            if len(column) < self._size:
+                column.append(None)
+
+    def build(self):
+        scalars = {k: _typed_column(v) for k, v in self._scalars.iteritems()}
+        histograms = {}
+
+        for name, (ranges, rows) in self._histograms.iteritems():
+            matrix = np.zeros((self._size, len(ranges)), dtype="int64")
+            present = np.zeros(self._size, dtype=bool)
+
+            for i, values in rows.iteritems():
+                if len(values) != len(ranges):
+                    raise ValueError("Histogram {} has inconsistent buckets within a batch".format(name))
+                matrix[i] = values
+                present[i] = True
+
+            histograms[name] = (ranges, matrix, present)
+
+        return PropertyBatch(self._size, scalars, histograms)
+
+
+def _typed_column(values):
+    present = [v for v in values if v is not None]
+    is_bool = lambda v: isinstance(v, (bool, np.bool_))
+
+    if present and len(present) == len(values) and all(is_bool(v) for v in present):
+        return np.array(values, dtype=bool)
+    elif present and all(isinstance(v, numbers.Integral) and not is_bool(v) for v in present):
+        if len(present) == len(values):
+            return np.array(values, dtype="int64")
+        return np.array([np.nan if v is None else v for v in values], dtype="float64")
+    elif present and all(isinstance(v, numbers.Real) and not is_bool(v) for v in present):
+        return np.array([np.nan if v is None else v for v in values], dtype="float64")
     else:
-        return cursor
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
 
 
-def _get_merged_histograms(cursor, path):
-    assert((len(path) == 2 and path[0] == "histograms") or (len(path) == 3 and path[0] == "keyedHistograms"))
-    result = {}
+def _missing_column(size, numeric):
+    if numeric:
+        return np.full(size, np.nan)
+
+    return np.full(size, None, dtype=object)
+
+
+class _HistogramAggregator:
+    """
+    Sums the histograms of pings into a dense int64 array per group, without building
+    Histogram objects. Each array holds, for each histogram, the parent buckets, the
+    children buckets and the number of pings with a parent and child histogram.
+    """
 
-    # Get parent histogram
-    parent = _get_ping_property(cursor, path)
+    def __init__(self, names, by, revision):
+        extractor = _PropertyExtractor(names)
+        invalid = _scalar_paths(extractor._scalars)
 
-    if parent:
-        name = parent.name
-        result[name + "_parent"] = parent
-        result[name] = parent
+        if invalid:
+            raise ValueError("Invalid histogram path(s) specified: {}".format(", ".join(invalid)))
+
+        self._by = by
+        self._by_extractor = _PropertyExtractor(by) if by else None
+        self._revision = revision
+        self._specs = []
+        self._size = 0
+
+        # Resolve the definitions once, on the driver
+        for in_payload, specs in extractor._histograms:
+            resolved = []
+
+            for path, histogram_name, name in specs:
+                definition = _get_definition(histogram_name, revision)
+                n_buckets = definition.n_buckets()
+                resolved.append((path, histogram_name, name, self._size, n_buckets, definition.bucket_index))
+                self._size += 2*n_buckets + 2
+
+            self._specs.append((in_payload, resolved))
+
+    def add(self, aggregates, ping):
+        if isinstance(ping, basestring):
+            ping = json.loads(ping)
+
+        if self._by_extractor:
+            properties = self._by_extractor.extract_scalars(ping)
+            group = tuple(properties.get(path, None) for path in self._by)
+        else:
+            group = ()
+
+        values = aggregates.get(group, None)
+        if values is None:
+            values = aggregates[group] = np.zeros(self._size, dtype="int64")
+
+        for in_payload, specs in self._specs:
+            cursor = ping.get("payload", None) if in_payload else ping
+            if cursor is None:
+                continue
+
+            children = cursor.get("childPayloads", None) or []
+
+            for path, histogram_name, name, offset, n_buckets, bucket_index in specs:
+                counter = offset + 2*n_buckets
+
+                if _add_histogram(values, offset, n_buckets, bucket_index, _lookup(cursor, path)):
+                    values[counter] += 1
+
+                for child in children:
+                    if _add_histogram(values, offset + n_buckets, n_buckets, bucket_index, _lookup(child, path)):
+                        values[counter + 1] += 1
+
+        return aggregates
+
+    def merge(self, aggregates, other):
+        for group, values in other.iteritems():
+            if group in aggregates:
+                aggregates[group] += values
+            else:
+                aggregates[group] = values
+
+        return aggregates
+
+    def to_histograms(self, values):
+        result = {}
+
+        for in_payload, specs in self._specs:
+            for path, histogram_name, name, offset, n_buckets, bucket_index in specs:
+                n_parents, n_children = values[offset + 2*n_buckets:offset + 2*n_buckets + 2]
+                parent = values[offset:offset + n_buckets]
+                children = values[offset + n_buckets:offset + 2*n_buckets]
+
+                if n_parents:
+                    result[name + "_parent"] = self._to_histogram(histogram_name, name, parent)
+                if n_children:
+                    result[name + "_children"] = self._to_histogram(histogram_name, name, children)
+                if n_parents or n_children:
+                    result[name] = self._to_histogram(histogram_name, name, parent + children)
 
-    cursor = cursor.get("childPayloads", {})
-    if not cursor:  # pre e10s ping
         return result
 
-    # Get children histograms
-    children = filter(lambda h: h is not None, [_get_ping_property(child, path) for child in cursor])
+    def _to_histogram(self, histogram_name, name, values):
+        histogram = Histogram(histogram_name, values.copy(), self._revision)
+        histogram.name = name
+        return histogram
 
-    if children:
-        name = children[0].name  # The parent histogram might not exist
-        result[name + "_children"] = reduce(lambda x, y: x + y, children)
 
-    # Merge parent and children
-    if parent or children:
-        metrics = ([parent] if parent else []) + children
-        result[name] = reduce(lambda x, y: x + y, metrics)
+def _add_histogram(values, offset, n_buckets, bucket_index, instance):
+    if instance is None:
+        return False
 
-    return result
+    if isinstance(instance, list):
+        values[offset:offset + n_buckets] += instance[:n_buckets]
+    else:
+        for bucket, count in instance["values"].iteritems():
+            i = bucket_index.get(int(bucket), None)
+            if i is not None:
+                values[offset + i] += count
+
+    return True
+
+
+def _lookup(cursor, path):
+    for partial in path:
+        cursor = cursor.get(partial, None)
+
+        if cursor is None:
+            return None
+
+    return cursor
+
+
+def _scalar_paths(node):
+    names, children = node
+    return names + [name for child in children.itervalues() for name in _scalar_paths(child)]
+
+
+def _extract_scalars(cursor, node, result):
+    names, children = node
+
+    for name in names:
+        result[name] = cursor
+
+    for partial, child in children.iteritems():
+        try:
+            value = cursor.get(partial, None)
+        except AttributeError:  # Not a dictionary
+            continue
+
+        if value is not None:
+            _extract_scalars(value, child, result)
+
+
+if __name__ == "__main__":
+    # All strategies keep the same ping per client, ties being resolved by the first ping;
+    # pings without a clientId are dropped and serialized ones are decoded
+    pings = [{"clientId": "client-{}".format(i % 7), "meta": {"Timestamp": i % 5}, "id": i} for i in range(63)]
+    pings += [{"meta": {"Timestamp": 9}, "id": 63}, json.dumps({"clientId": "client-7", "meta": {"Timestamp": 0}, "id": 64})]
+    sc = LocalContext(1)
+
+    def expected(pings, selection):
+        winners = {}
+        for ping in (json.loads(p) if isinstance(p, basestring) else p for p in pings):
+            client_id = ping.get("clientId", None)
+            if client_id is not None and (client_id not in winners or selection(ping) > selection(winners[client_id])):
+                winners[client_id] = ping
+        return sorted(ping["id"] for ping in winners.itervalues())
+
+    for selection, rank in [("first", lambda p: 0), ("latest", lambda p: p["meta"]["Timestamp"]),
+                            (lambda p: -p["id"], lambda p: -p["id"])]:
+        for strategy in ("shuffle", "keys"):
+            rdd = sc.parallelize(pings, 4)
+            selected = get_one_ping_per_client(rdd, strategy, selection).map(lambda p: p["id"]).collect()
+            assert sorted(selected) == expected(pings, rank), (strategy, selection)
+
+        # The keys strategy shuffles the pings of too many clients instead
+        _max_broadcast_winners = 3
+        selected = get_one_ping_per_client(sc.parallelize(pings, 4), "keys", selection).map(lambda p: p["id"])
+        assert sorted(selected.collect()) == expected(pings, rank), selection
+        _max_broadcast_winners = 10**7
+
+        # The partitioned strategy needs all pings of a client in the same partition
+        by_client = sorted(pings[:63], key=lambda p: p["clientId"])
+        partitioned = get_one_ping_per_client(sc.parallelize(by_client, 7), "partitioned", selection)
+        assert sorted(p["id"] for p in partitioned.collect()) == expected(by_client, rank), selection
+
+    # Batches hold the properties of the extraction per ping, including counts beyond 32 bits
+    bucket_count = _get_definition("GC_MS", _default_revision).n_buckets()
+    large = np.zeros(bucket_count, dtype="int64")
+    large[1] = 2**33
+    pings = [{"clientId": "a", "payload": {"histograms": {"GC_MS": large, "SEARCH_COUNTS": {"values": {"0": 3}}}}},
+             {"clientId": "b", "payload": {"histograms": {"SEARCH_COUNTS": {"values": {"0": 1}}}}},
+             {"clientId": "c", "payload": {}}]
+    extractor = _PropertyExtractor(["clientId", "payload/histograms/GC_MS", "payload/histograms/SEARCH_COUNTS"])
+    batches = list(extractor.extract_batches(pings, 2))
+    frame = PropertyBatch.concat(batches).to_dataframe()
+
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert sorted(frame.columns) == ["GC_MS", "GC_MS_parent", "SEARCH_COUNTS", "SEARCH_COUNTS_parent", "clientId"]
+
+    for i, properties in enumerate(extractor.extract_partition(pings)):
+        for name in frame.columns:
+            value = properties.get(name, None)
+            if isinstance(value, pd.Series):
+                assert np.array_equal(frame[name][i], value.values), (i, name)
+            elif value is None:
+                assert frame[name][i] is None or np.isnan(frame[name][i]), (i, name)
+            else:
+                assert frame[name][i] == value, (i, name)
+
+    assert frame["GC_MS"][0][1] == 2**33
+    assert np.isnan(PropertyBatch.concat(batches).percentiles("GC_MS", [50])[1:]).all()